@@ -0,0 +1,73 @@
+"""Compare the ways a chat's chain can be loaded, by time and size.
+
+``rows`` reads the chains table, ``json`` parses the json blob the bot
+used to store, ``packed`` reads a serialized snapshot and ``mapped`` maps
+a chain file and walks one sentence from it. Run with
+``python -m benchmarks.chains``.
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import markovify
+
+
+def best_of(repeat, func, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_json(data):
+    return markovify.Chain.from_json(json.loads(data)).model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,5000,50000')
+    parser.add_argument('--repeat', '-r', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{os.path.join(tmp, "bench.db")}'
+        # settings are read on import, so the database is set up first
+        os.environ['DATABASE_URL'] = url
+        from benchmarks.speech import migrate
+        from benchmarks.filters import message_stream
+        migrate()
+        from markov import storage
+        from markov.chain import serialize, deserialize
+        from markov.chain import MappedChain, write_mapped
+
+        def walk_mapped(path):
+            return MappedChain(path).walk()
+
+        print(f'{"lines":>7} {"format":>7} {"load ms":>9} {"bytes":>11}')
+        for size in map(int, args.sizes.split(',')):
+            text = '\n'.join(message_stream(size))
+            chain = markovify.NewlineText(text).chain
+            chat_id = str(size)
+            storage.count_transitions(chat_id, chain.model)
+            blob = json.dumps(chain.to_json())
+            packed = serialize(chain.model)
+            assert deserialize(packed) == load_json(blob) == chain.model
+            mapped = os.path.join(tmp, f'{chat_id}.chain')
+            write_mapped(mapped, chain.model, size)
+            cases = [
+                ('rows', storage.load_chain, chat_id, None),
+                ('json', load_json, blob, len(blob.encode())),
+                ('packed', deserialize, packed, len(packed)),
+                ('mapped', walk_mapped, mapped, os.path.getsize(mapped))
+            ]
+            for name, func, data, length in cases:
+                elapsed = best_of(args.repeat, func, data) * 1000
+                length = length or ''
+                print(f'{size:>7} {name:>7} {elapsed:>9.1f} {length:>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Compare the filter engine with searching each filter pattern in turn.
+
+Run with ``python -m benchmarks.filters``.
+"""
+import re
+import time
+import random
+import argparse
+from markov.filters import PATTERNS, FilterEngine, keywords_pattern
+
+WORDS = (
+    'the a to and of i you it is that in this for on was with but so lol '
+    'what just like have not are be do no yes ok haha when can we they he '
+    'she get going got now think know really good time today tomorrow '
+    'kkkk rs pra que não é de o um uma bom dia noite você eu isso'
+).split()
+
+LINKS = [
+    'https://example.com/watch?v={n}', 'http://t.co/{n}',
+    'ftp://files.example.org/{n}.zip'
+]
+
+EMAILS = ['someone{n}@example.com', 'first.last+{n}@mail.example.org']
+
+PATTERNS_EXTRA = {'phone': r'\+?\d[\d -]{7,}\d'}
+
+KEYWORDS = ['buy now', 'free money', 'click here', 'limited offer']
+
+
+def message_stream(count, seed=42):
+    """Chat-like messages, about one in ten of them filtered."""
+    rng = random.Random(seed)
+    for n in range(count):
+        words = rng.choices(WORDS, k=max(1, int(rng.expovariate(1 / 12))))
+        roll = rng.random()
+        if roll < 0.05:
+            words.insert(rng.randrange(len(words) + 1),
+                         rng.choice(LINKS).format(n=n))
+        elif roll < 0.07:
+            words.append(rng.choice(EMAILS).format(n=n))
+        elif roll < 0.08:
+            words.append(rng.choice(KEYWORDS))
+        elif roll < 0.09:
+            words.append(f'+55 11 9{n:04d}-{n % 9999:04d}')
+        yield ' '.join(words)
+
+
+def per_pattern(patterns):
+    """The filter as it was, searching every raw pattern in turn."""
+    values = list(patterns.values())
+    return lambda text: any(re.search(p, text, re.I) for p in values)
+
+
+def measure(matcher, messages, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in messages:
+            matcher(text)
+        best = min(best, time.perf_counter() - start)
+    return len(messages) / best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', '-n', type=int, default=50000)
+    parser.add_argument('--repeat', '-r', type=int, default=5)
+    args = parser.parse_args()
+
+    messages = list(message_stream(args.messages))
+    patterns = dict(PATTERNS, **PATTERNS_EXTRA)
+    patterns['keywords'] = keywords_pattern(KEYWORDS)
+    engine = FilterEngine(patterns)
+    baseline = per_pattern(patterns)
+    assert all(bool(engine.match(t)) == baseline(t) for t in messages)
+
+    for name, matcher in [('per pattern', baseline),
+                          ('engine', engine.match)]:
+        rate = measure(matcher, messages, args.repeat)
+        print(f'{name:>12}: {rate:12,.0f} messages/sec')
+
+
+if __name__ == '__main__':
+    main()
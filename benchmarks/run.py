@@ -0,0 +1,99 @@
+"""Run the speech benchmarks over a grid of corpus sizes, models and dbs.
+
+Each case runs in a fresh interpreter, so settings and peak memory do not
+leak between them. Results are written as JSON, and can be compared with
+a stored baseline to fail on regressions::
+
+    python -m benchmarks.run --sizes 100,1000 --output results.json
+    python -m benchmarks.run --baseline results.json
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+SIZES = [100, 1000, 5000, 50000]
+
+MODELS = {'newline': '', 'posified': 'en'}
+
+# measured phases, compared by throughput against the baseline
+PHASES = ['ingest', 'load', 'generate']
+
+
+def run_case(size, model, database, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        if database == 'sqlite':
+            url = f'sqlite:///{os.path.join(tmp, "bench.db")}'
+        else:
+            url = database
+        env = dict(
+            os.environ, DATABASE_URL=url, LOG_LEVEL='WARNING',
+            MODEL_LANG=args.lang if MODELS[model] else ''
+        )
+        command = [sys.executable, '-m', 'benchmarks.speech', '-n', str(size)]
+        if args.corpus:
+            command += ['--corpus', args.corpus]
+        result = subprocess.run(
+            command, env=env, stdout=subprocess.PIPE, check=True,
+            universal_newlines=True
+        )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def regressions(results, baseline, tolerance):
+    """Phases whose throughput fell more than ``tolerance`` below baseline."""
+    found = []
+    for case, report in results.items():
+        expected = baseline.get(case, {})
+        for phase in PHASES:
+            if phase not in report or phase not in expected:
+                continue
+            rate, base = report[phase]['rate'], expected[phase]['rate']
+            if rate < base * (1 - tolerance):
+                found.append(f'{case} {phase}: {rate:.1f}/s < {base:.1f}/s')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)))
+    parser.add_argument('--models', default=','.join(MODELS))
+    parser.add_argument(
+        '--databases', default='sqlite',
+        help='comma separated: sqlite and/or database urls'
+    )
+    parser.add_argument('--lang', default='en', help='posified model lang')
+    parser.add_argument('--corpus', help='file to replay messages from')
+    parser.add_argument('--output', '-o', help='file to write results to')
+    parser.add_argument('--baseline', '-b', help='results to compare with')
+    parser.add_argument('--tolerance', '-t', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = {}
+    for database in args.databases.split(','):
+        label = database.split(':')[0]
+        for model in args.models.split(','):
+            for size in map(int, args.sizes.split(',')):
+                case = f'{model}-{label}-{size}'
+                results[case] = run_case(size, model, database, args)
+                print(case, json.dumps(results[case]), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f'regression: {regression}', file=sys.stderr)
+        return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""Measure the ingest, load and generation paths of one chat.
+
+Settings are read from the environment like the bot does, so this is
+meant to be run by ``python -m benchmarks.run`` once per configuration.
+It prints a JSON report on stdout.
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import statistics
+from alembic import command
+from attrdict import AttrDict
+from alembic.config import Config
+from benchmarks.filters import message_stream
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def migrate():
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'migrations'))
+    command.upgrade(config, 'head')
+
+
+def load_corpus(lines, path=None):
+    """``lines`` messages replayed from a file, or synthetic ones."""
+    if not path:
+        return list(message_stream(lines))
+    with open(path) as corpus:
+        messages = [line.strip() for line in corpus if line.strip()]
+    return messages[:lines]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def summary(samples):
+    """Throughput and latency percentiles, in operations/sec and ms."""
+    cuts = statistics.quantiles(samples, n=100) if len(samples) > 1 else (
+        samples * 99
+    )
+    return {
+        'count': len(samples),
+        'rate': len(samples) / sum(samples),
+        'p50': cuts[49] * 1000,
+        'p99': cuts[98] * 1000
+    }
+
+
+def load_model(speech, chat):
+    model = speech.get_model(chat)
+    # the corpus is read on the first overlap check, count it in the load
+    len(model.overlap)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', '-n', type=int, default=1000)
+    parser.add_argument('--corpus', '-c', help='file to replay messages from')
+    parser.add_argument('--loads', type=int, default=5)
+    parser.add_argument('--sentences', type=int, default=200)
+    args = parser.parse_args()
+
+    migrate()
+    from markov import speech
+    if speech.nlp:
+        try:
+            speech.nlp[speech.nlp.languages[0]]
+        except KeyError:
+            print(json.dumps({'skipped': 'spacy model not installed'}))
+            return
+    random.seed(42)
+    chat = AttrDict({'id': random.randrange(-10 ** 12, -1)})
+    corpus = load_corpus(args.lines, args.corpus)
+
+    ingest = [timed(speech.update_model, chat, line) for line in corpus]
+    if speech.buffer:
+        ingest.append(timed(speech.buffer.flush))
+    load = []
+    for _ in range(args.loads):
+        speech.flush(chat)
+        load.append(timed(load_model, speech, chat))
+    generate = [
+        timed(speech.new_message, chat) for _ in range(args.sentences)
+    ]
+    speech.delete_model(chat)
+
+    print(json.dumps({
+        'lines': len(corpus),
+        'ingest': summary(ingest),
+        'load': summary(load),
+        'generate': summary(generate),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+import threading
+
+
+class Background:
+    """Run ``run`` in daemon threads started the first time they are needed.
+
+    Subclasses call ``start`` whenever they are given work. Only the first
+    call starts the threads, one for each tuple of arguments ``workers``
+    returns.
+    """
+
+    def __init__(self):
+        self.threads = []
+        self.start_lock = threading.Lock()
+
+    def workers(self):
+        return [()]
+
+    def start(self):
+        """Start the threads; return True only from the call that did."""
+        if self.threads:
+            return False
+        with self.start_lock:
+            if self.threads:
+                return False
+            for args in self.workers():
+                thread = threading.Thread(
+                    target=self.run, args=args, daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+        return True
+
+    def run(self, *args):
+        raise NotImplementedError
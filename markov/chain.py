@@ -0,0 +1,495 @@
+import os
+import sys
+import json
+import mmap
+import random
+import bisect
+import struct
+import logging
+import itertools
+import markovify
+from array import array
+from markovify.chain import BEGIN, END
+
+logger = logging.getLogger(__name__)
+
+# bits used by each token id in a packed state
+ID_BITS = 32
+
+# marker and version of the serialized chain format
+MAGIC = b'MKCH'
+FORMAT_VERSION = 1
+
+# magic, version, state size, words, states and transitions
+HEADER = struct.Struct('<4sBBIII')
+
+# marker and version of the mapped chain file format
+MAPPED_MAGIC = b'MKMM'
+MAPPED_VERSION = 1
+
+# magic, version, state size, seq, words, states and transitions, padded
+# so the arrays that follow are aligned
+MAPPED_HEADER = struct.Struct('<4sBB2xQIII4x')
+
+
+def count_transitions(model, counts, weight=1):
+    """Add ``weight`` times every transition of ``counts`` into ``model``.
+
+    Both are chain models (``{state: {word: count}}``). Transitions whose
+    count drops to zero are removed, and so are states left without any
+    transition, so the result is the same model a full build would give.
+    """
+    for state, follows in counts.items():
+        current = model.setdefault(state, {})
+        for word, count in follows.items():
+            total = current.get(word, 0) + weight * count
+            if total > 0:
+                current[word] = total
+            else:
+                current.pop(word, None)
+        if not current:
+            del model[state]
+    return model
+
+
+def update_chain(chain, added=None, removed=None):
+    """Slide ``chain`` forward by counting ``added`` in and ``removed`` out.
+
+    Both arguments are chains (or None) built from the lines entering and
+    leaving the window, so the cost of an update depends only on their size
+    and not on the size of the whole corpus.
+    """
+    logger.debug('updating chain incrementally')
+    if added is not None:
+        chain.update(added.model)
+    if removed is not None:
+        chain.update(removed.model, weight=-1)
+    return chain
+
+
+def serialize(model):
+    """Pack a chain model into bytes.
+
+    After the header come the byte length of every word, the utf-8 words,
+    and then, for every state, its word ids, its number of transitions and
+    the word ids and counts of those transitions. Numbers are little endian
+    unsigned 32 bit integers, so reading is mostly copying arrays.
+    """
+    vocab = Vocabulary()
+
+    states, sizes, follows, counts = (array('I') for _ in range(4))
+    for state, nexts in model.items():
+        states.extend(map(vocab.intern, state))
+        sizes.append(len(nexts))
+        follows.extend(map(vocab.intern, nexts))
+        counts.extend(nexts.values())
+    words = [word.encode() for word in vocab]
+    lengths = array('I', map(len, words))
+    arrays = [lengths, states, sizes, follows, counts]
+    if sys.byteorder == 'big':
+        for values in arrays:
+            values.byteswap()
+    state_size = len(next(iter(model))) if model else 0
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, state_size, len(vocab), len(sizes),
+        len(counts)
+    )
+    return b''.join(
+        [header, lengths.tobytes(), b''.join(words)] +
+        [values.tobytes() for values in arrays[1:]]
+    )
+
+
+def deserialize(data):
+    """Unpack a chain model serialized by ``serialize``.
+
+    Chains saved as json, the way ``markovify.Chain.to_json`` lays them out
+    (and possibly encoded twice, as the bot used to store them), are read
+    too. Raises ValueError for data in neither format.
+    """
+    if isinstance(data, str) or bytes(data[:len(MAGIC)]) != MAGIC:
+        model = json.loads(data)
+        if isinstance(model, str):
+            model = json.loads(model)
+        return {tuple(state): follows for state, follows in model}
+    if len(data) < HEADER.size:
+        raise ValueError('truncated chain data')
+    _, version, state_size, words, states, transitions = HEADER.unpack_from(
+        data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'unknown chain format version {version}')
+    data = memoryview(data)[HEADER.size:]
+
+    def take(count):
+        nonlocal data
+        values = array('I')
+        if len(data) < count * values.itemsize:
+            raise ValueError('truncated chain data')
+        values.frombytes(data[:count * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        data = data[count * values.itemsize:]
+        return values
+
+    vocab, offset = [], 0
+    for length in take(words):
+        vocab.append(str(data[offset:offset + length], 'utf-8'))
+        offset += length
+    data = data[offset:]
+    ids, sizes = take(states * state_size), take(states)
+    follows = [vocab[token] for token in take(transitions)]
+    counts = take(transitions)
+    model, start = {}, 0
+    for i, size in enumerate(sizes):
+        state = ids[i * state_size:(i + 1) * state_size]
+        model[tuple(map(vocab.__getitem__, state))] = dict(
+            zip(follows[start:start + size], counts[start:start + size])
+        )
+        start += size
+    return model
+
+
+def write_mapped(path, model, seq):
+    """Write a chain model to the file ``MappedChain`` reads.
+
+    ``seq`` tells which version of the chat the file was built from. After
+    the header come the packed states, sorted, the index of the first
+    transition of every state, the word ids and cumulative counts of the
+    transitions, the byte offset of every word and the utf-8 words. The
+    file is written aside and moved into place, so readers never see it
+    half written and keep the pages of any older file they mapped.
+    """
+    state_size = len(next(iter(model)))
+    if state_size * ID_BITS > 64:
+        raise ValueError(f'cannot map chains of state size {state_size}')
+    vocab = Vocabulary()
+
+    vocab.intern(BEGIN)
+    vocab.intern(END)
+    rows = sorted(
+        (pack(map(vocab.intern, state)), follows)
+        for state, follows in model.items()
+    )
+    keys, offsets = array('Q', (key for key, _ in rows)), array('I', [0])
+    follows, cumdist = array('I'), array('I')
+    for _, nexts in rows:
+        follows.extend(map(vocab.intern, nexts))
+        cumdist.extend(itertools.accumulate(nexts.values()))
+        offsets.append(len(follows))
+    words = [word.encode() for word in vocab]
+    word_offsets = array('I', itertools.accumulate(map(len, words), initial=0))
+    arrays = [keys, offsets, follows, cumdist, word_offsets]
+    if sys.byteorder == 'big':
+        for values in arrays:
+            values.byteswap()
+    header = MAPPED_HEADER.pack(
+        MAPPED_MAGIC, MAPPED_VERSION, state_size, seq, len(vocab), len(keys),
+        len(follows)
+    )
+    partial = f'{path}.{os.getpid()}.tmp'
+    with open(partial, 'wb') as f:
+        f.write(header)
+        for values in arrays:
+            values.tofile(f)
+        f.write(b''.join(words))
+    os.replace(partial, path)
+
+
+class Vocabulary(list):
+    """The words of a chain, numbered in the order they are first seen."""
+
+    def __init__(self):
+        super().__init__()
+        self.ids = {}
+
+    def intern(self, word):
+        token = self.ids.get(word)
+        if token is None:
+            token = self.ids[word] = len(self)
+            self.append(word)
+        return token
+
+
+def pack(tokens):
+    """Pack the token ids of a state into a single integer."""
+    key = 0
+    for token in tokens:
+        key = key << ID_BITS | token
+    return key
+
+
+class Chain(markovify.Chain):
+    """A markovify chain that can be updated in place.
+
+    Unlike markovify, which rebuilds the weights of a state every time it
+    moves from it, the choices and cumulative weights of each state are
+    computed on its first visit and kept until an update touches it. The
+    number of transitions is kept up to date too, so sizing the chain costs
+    nothing.
+    """
+
+    def __init__(self, corpus, state_size, model=None):
+        self.tables = {}
+        super().__init__(corpus, state_size, model)
+        self.size = sum(len(follows) for follows in self.model.values())
+
+    def update(self, counts, weight=1):
+        self.size -= sum(len(self.model.get(state, ())) for state in counts)
+        count_transitions(self.model, counts, weight)
+        for state in counts:
+            self.tables.pop(state, None)
+            self.size += len(self.model.get(state, ()))
+        if (BEGIN,) * self.state_size in self.model:
+            self.precompute_begin_state()
+
+    def move(self, state):
+        table = self.tables.get(state)
+        if table is None:
+            follows = self.model.get(state)
+            if not follows:
+                # pruned states end the sentence
+                return END
+            table = self.tables[state] = (
+                list(follows), list(itertools.accumulate(follows.values()))
+            )
+        choices, cumdist = table
+        r = random.random() * cumdist[-1]
+        return choices[bisect.bisect(cumdist, r)]
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, state):
+        return state in self.model
+
+
+class CompactChain:
+    """A chain that stores its model as integer arrays.
+
+    Tokens are interned into a vocabulary and states are packed into a
+    single integer made of their token ids. Each state maps to one array
+    holding the ids of its next tokens followed by their cumulative counts,
+    which is what sampling needs, in the same order markovify uses, so both
+    chains produce the same sentences from the same random numbers.
+    """
+
+    def __init__(self, corpus, state_size, model=None):
+        self.state_size = state_size
+        self.vocab = Vocabulary()
+        self.ids = self.vocab.ids
+        self.states = {}
+        self.size = 0
+        self.mask = (1 << ID_BITS * state_size) - 1
+        self.begin = self.vocab.intern(BEGIN)
+        self.end = self.vocab.intern(END)
+        if model is None:
+            model = markovify.Chain(corpus, state_size).model
+        self.update(model)
+
+    def key(self, state):
+        return pack(self.ids[word] for word in state)
+
+    def follows(self, key):
+        row = self.states.get(key)
+        if row is None:
+            return {}
+        size = len(row) // 2
+        counts = itertools.chain(
+            row[size:size + 1],
+            (b - a for a, b in zip(row[size:], row[size + 1:]))
+        )
+        return dict(zip(row[:size], counts))
+
+    def update(self, counts, weight=1):
+        for state, follows in counts.items():
+            key = pack(self.vocab.intern(word) for word in state)
+            current = self.follows(key)
+            self.size -= len(current)
+            for word, count in follows.items():
+                token = self.vocab.intern(word)
+                total = current.get(token, 0) + weight * count
+                if total > 0:
+                    current[token] = total
+                else:
+                    current.pop(token, None)
+            self.size += len(current)
+            if current:
+                self.states[key] = array('I', current) + array(
+                    'I', itertools.accumulate(current.values())
+                )
+            else:
+                self.states.pop(key, None)
+
+    def choose(self, key):
+        row = self.states.get(key)
+        if row is None:
+            # pruned states end the sentence
+            return self.end
+        size = len(row) // 2
+        r = random.random() * row[-1]
+        return row[bisect.bisect(row, r, size, 2 * size) - size]
+
+    def move(self, state):
+        return self.vocab[self.choose(self.key(state))]
+
+    def gen(self, init_state=None):
+        key = self.key(init_state or (BEGIN,) * self.state_size)
+        while True:
+            token = self.choose(key)
+            if token == self.end:
+                break
+            yield self.vocab[token]
+            key = (key << ID_BITS | token) & self.mask
+
+    def walk(self, init_state=None):
+        return list(self.gen(init_state))
+
+    @property
+    def model(self):
+        """The chain as a markovify model, mostly useful for debugging."""
+        return {
+            self.unpack(key): {
+                self.vocab[token]: count
+                for token, count in self.follows(key).items()
+            }
+            for key in self.states
+        }
+
+    def unpack(self, key):
+        tokens = []
+        for _ in range(self.state_size):
+            tokens.append(self.vocab[key & (1 << ID_BITS) - 1])
+            key >>= ID_BITS
+        return tuple(reversed(tokens))
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, state):
+        try:
+            return self.key(state) in self.states
+        except KeyError:
+            return False
+
+
+class MappedChain:
+    """A read only chain walked straight from a file mapped in memory.
+
+    The file is laid out by ``write_mapped``: states are searched in their
+    sorted array and sampled from the cumulative counts of their slice of
+    the transition arrays, like ``CompactChain`` does, so both produce the
+    same sentences from the same random numbers. Nothing is copied out of
+    the file up front, so opening a chain costs the same whatever its size
+    and every process mapping the file shares its pages.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder == 'big':
+            raise ValueError('mapped chains need a little endian host')
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buffer) < MAPPED_HEADER.size:
+            raise ValueError('truncated chain file')
+        (magic, version, self.state_size, self.seq, words, states,
+         transitions) = MAPPED_HEADER.unpack_from(self.buffer)
+        if magic != MAPPED_MAGIC:
+            raise ValueError('not a chain file')
+        if version != MAPPED_VERSION:
+            raise ValueError(f'unknown chain file version {version}')
+        view = memoryview(self.buffer)
+        offset = MAPPED_HEADER.size
+
+        def take(code, count):
+            nonlocal offset
+            size = count * struct.calcsize(code)
+            if offset + size > len(view):
+                raise ValueError('truncated chain file')
+            values = view[offset:offset + size].cast(code)
+            offset += size
+            return values
+
+        self.keys = take('Q', states)
+        self.offsets = take('I', states + 1)
+        self.follows = take('I', transitions)
+        self.cumdist = take('I', transitions)
+        self.word_offsets = take('I', words + 1)
+        self.words = take('B', self.word_offsets[-1])
+        self.mask = (1 << ID_BITS * self.state_size) - 1
+        self.begin, self.end = 0, 1
+        self._ids = None
+
+    def word(self, token):
+        start, end = self.word_offsets[token], self.word_offsets[token + 1]
+        return str(self.words[start:end], 'utf-8')
+
+    @property
+    def ids(self):
+        """Token id of every word, only built when a state is looked up."""
+        if self._ids is None:
+            self._ids = {
+                self.word(token): token
+                for token in range(len(self.word_offsets) - 1)
+            }
+        return self._ids
+
+    def key(self, state):
+        return pack(self.ids[word] for word in state)
+
+    def find(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        return i
+
+    def choose(self, key):
+        try:
+            i = self.find(key)
+        except KeyError:
+            # pruned states end the sentence
+            return self.end
+        start, end = self.offsets[i], self.offsets[i + 1]
+        r = random.random() * self.cumdist[end - 1]
+        return self.follows[bisect.bisect(self.cumdist, r, start, end)]
+
+    def move(self, state):
+        return self.word(self.choose(self.key(state)))
+
+    def gen(self, init_state=None):
+        # the begin state packs to zero, no need to look its words up
+        key = self.key(init_state) if init_state else self.begin
+        while True:
+            token = self.choose(key)
+            if token == self.end:
+                break
+            yield self.word(token)
+            key = (key << ID_BITS | token) & self.mask
+
+    def walk(self, init_state=None):
+        return list(self.gen(init_state))
+
+    @property
+    def model(self):
+        """The chain as a markovify model, mostly useful for debugging."""
+        model = {}
+        for i, key in enumerate(self.keys):
+            tokens = []
+            for _ in range(self.state_size):
+                tokens.append(self.word(key & (1 << ID_BITS) - 1))
+                key >>= ID_BITS
+            start, end = self.offsets[i], self.offsets[i + 1]
+            cumdist = self.cumdist[start:end].tolist()
+            counts = [b - a for a, b in zip([0] + cumdist[:-1], cumdist)]
+            model[tuple(reversed(tokens))] = dict(
+                zip(map(self.word, self.follows[start:end]), counts)
+            )
+        return model
+
+    def __len__(self):
+        return len(self.follows)
+
+    def __contains__(self, state):
+        try:
+            self.find(self.key(state))
+        except KeyError:
+            return False
+        return True
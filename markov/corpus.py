@@ -0,0 +1,109 @@
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+
+class OverlapIndex:
+    """The sentences of a corpus indexed by word, for overlap checks.
+
+    markovify rejects a generated sentence by searching every one of its
+    n-grams in the whole joined corpus, for every try. This index maps each
+    word to the sentences it is in, so a run of words is only compared with
+    the sentences holding its rarest word. It is a single index, one
+    reference per distinct word of a sentence, whatever the run lengths
+    asked about, and sentences can be added and removed as the corpus
+    changes.
+
+    With a ``source``, a callable returning an iterable of sentences, the
+    corpus is only read on the first lookup, one sentence at a time.
+    Until then ``add`` and ``remove`` do nothing, as the source is expected
+    to read the corpus as it is by then.
+    """
+
+    def __init__(self, sentences=(), source=None):
+        self._sentences = collections.deque()
+        self.words = {}
+        self.source = source
+        self.lock = threading.Lock()
+        self.extend(sentences)
+
+    @property
+    def sentences(self):
+        self.load()
+        return self._sentences
+
+    def load(self):
+        if self.source is None:
+            return
+        with self.lock:
+            if self.source is not None:
+                logger.debug('loading the corpus')
+                self.extend(self.source())
+                self.source = None
+
+    def extend(self, sentences):
+        for sentence in sentences:
+            sentence = tuple(sentence)
+            self._sentences.append(sentence)
+            for word in set(sentence):
+                self.words.setdefault(word, []).append(sentence)
+
+    def add(self, sentences):
+        if self.source is None:
+            self.extend(sentences)
+
+    def remove(self, sentences):
+        if self.source is not None:
+            return
+        for sentence in sentences:
+            sentence = tuple(sentence)
+            try:
+                self._sentences.remove(sentence)
+            except ValueError:
+                continue
+            for word in set(sentence):
+                holders = self.words[word]
+                holders.remove(sentence)
+                if not holders:
+                    del self.words[word]
+
+    def contains(self, words, size):
+        """Whether any ``size`` words in a row of ``words`` are in the corpus.
+
+        Sentences shorter than ``size`` are looked up as a whole.
+        """
+        self.load()
+        words = tuple(words)
+        size = min(size, len(words))
+        if size < 1:
+            return False
+        counts = [len(self.words.get(word, ())) for word in words]
+        for start in range(len(words) - size + 1):
+            window = counts[start:start + size]
+            offset = min(range(size), key=window.__getitem__)
+            if not window[offset]:
+                continue
+            run = words[start:start + size]
+            rarest = self.words[run[offset]]
+            if any(matches(sentence, run, offset) for sentence in rarest):
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.sentences)
+
+
+def matches(sentence, run, offset):
+    """Whether ``run`` is in ``sentence``, searched by its word ``offset``."""
+    anchor, size = run[offset], len(run)
+    i = offset
+    while True:
+        try:
+            i = sentence.index(anchor, i)
+        except ValueError:
+            return False
+        if sentence[i - offset:i - offset + size] == run:
+            return True
+        i += 1
@@ -0,0 +1,104 @@
+import queue
+import logging
+import telebot
+import itertools
+from markov.background import Background
+
+logger = logging.getLogger(__name__)
+
+# task priorities, lower ones run first
+COMMAND = 0
+MESSAGE = 1
+
+# updates asked from telegram, chat_member ones are only sent when asked for
+ALLOWED_UPDATES = ['message', 'chat_member', 'my_chat_member']
+
+
+class Dispatcher(Background):
+    """Run tasks on a pool of worker threads, one queue per worker.
+
+    Tasks are routed to a worker by hashing their key (a chat id), so the
+    tasks of a chat run one at a time and in order, and a slow chat only
+    holds up the chats that share its worker. Within a queue, commands go
+    ahead of plain messages.
+
+    Each queue holds at most ``size`` tasks. When it is full, ``put`` waits
+    up to ``timeout`` seconds for room (forever if None), which slows down
+    whoever is feeding updates in, and then drops the task.
+    """
+
+    def __init__(self, workers, size, timeout=None):
+        super().__init__()
+        self.queues = [queue.PriorityQueue(size) for _ in range(workers)]
+        self.timeout = timeout
+        self.counter = itertools.count()
+
+    def queue(self, key):
+        return self.queues[hash(key) % len(self.queues)]
+
+    def put(self, key, priority, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)``; return False if it was dropped."""
+        self.start()
+        task = (priority, next(self.counter), func, args, kwargs)
+        try:
+            self.queue(key).put(task, timeout=self.timeout)
+        except queue.Full:
+            logger.warning(f'queue is full, dropping task for chat-id:{key}')
+            return False
+        return True
+
+    def workers(self):
+        return [(tasks,) for tasks in self.queues]
+
+    def run(self, tasks):
+        while True:
+            _, _, func, args, kwargs = tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('error running task')
+            finally:
+                tasks.task_done()
+
+    def idle(self):
+        """Whether no task is queued or running."""
+        return not any(tasks.unfinished_tasks for tasks in self.queues)
+
+    def join(self):
+        """Wait until every queued task has run."""
+        for tasks in self.queues:
+            tasks.join()
+
+
+class DispatchingBot(telebot.TeleBot):
+    """A TeleBot that runs its handlers through a Dispatcher.
+
+    Updates are still received on a single thread, but handling them is
+    left to the dispatcher, keyed by the chat of each message. Polling asks
+    for ``ALLOWED_UPDATES``, and every raw update is passed to ``received``
+    before telebot parses it.
+    """
+
+    def __init__(self, token, dispatcher, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = dispatcher
+        self.received = lambda update: None
+
+    def get_updates(self, offset=None, limit=None, timeout=20,
+                    allowed_updates=None):
+        updates = telebot.apihelper.get_updates(
+            self.token, offset, limit, timeout,
+            allowed_updates or ALLOWED_UPDATES
+        )
+        for update in updates:
+            self.received(update)
+        return [telebot.types.Update.de_json(update) for update in updates]
+
+    def _exec_task(self, task, *args, **kwargs):
+        message = args[0] if args else None
+        chat = getattr(message, 'chat', None)
+        text = getattr(message, 'text', None) or ''
+        priority = COMMAND if text.startswith('/') else MESSAGE
+        self.dispatcher.put(
+            chat and chat.id, priority, task, *args, **kwargs
+        )
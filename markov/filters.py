@@ -1,16 +1,67 @@
 import re
+import logging
 from markov.settings import settings
 
+logger = logging.getLogger(__name__)
+
+# the email lookbehind only tries addresses from the start of a word, the
+# result is the same but without retrying every suffix of every word
 PATTERNS = {
-    'email': r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+',
+    'email': (
+        r'(?<![a-zA-Z0-9_.+-])[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
+    ),
     'url': r'(https?|ftp)://[^\s/$.?#].[^\s]*'
 }
 
-filters = list(filter(None, [PATTERNS.get(f, '') for f in settings.FILTERS]))
+
+def keywords_pattern(keywords):
+    words = sorted(map(re.escape, keywords), key=len, reverse=True)
+    return r'\b(?:' + '|'.join(words) + r')\b'
+
+
+def enabled_patterns():
+    """The patterns of the filters enabled in the settings, by name.
+
+    These are the built in filters named in ``FILTERS``, the user defined
+    ``FILTER_PATTERNS`` and, if there are any, the ``FILTER_KEYWORDS``.
+    """
+    patterns = {f: PATTERNS[f] for f in settings.FILTERS if f in PATTERNS}
+    patterns.update(settings.FILTER_PATTERNS)
+    if settings.FILTER_KEYWORDS:
+        patterns['keywords'] = keywords_pattern(settings.FILTER_KEYWORDS)
+    return patterns
+
+
+class FilterEngine:
+    """Match text against many filters in a single pass.
+
+    Every filter becomes a named group of one case insensitive alternation,
+    compiled once, and the group that matched tells which filter it was.
+    Patterns cannot use numbered backreferences, as the groups around
+    them shift their numbers.
+    """
+
+    def __init__(self, patterns):
+        self.names = list(patterns)
+        self.regex = re.compile('|'.join(
+            f'(?P<f{i}>{pattern})'
+            for i, pattern in enumerate(patterns.values())
+        ), re.I) if patterns else None
+
+    def match(self, text):
+        """Return the name of the filter matching ``text``, or None."""
+        found = self.regex and self.regex.search(text)
+        return self.names[int(found.lastgroup[1:])] if found else None
+
+
+engine = FilterEngine(enabled_patterns())
 
 
 def message_filter(message):
     if not message.text:
         return False
 
-    return not any(re.search(f, message.text, re.I) for f in filters)
+    name = engine.match(message.text)
+    if name:
+        logger.debug(f'message filtered by {name} in chat {message.chat.id}')
+    return not name
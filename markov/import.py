@@ -0,0 +1,277 @@
+"""Seed chats with the messages of a Telegram export or a text file.
+
+Run with ``python -m markov.import``. Exports are read a chat at a time,
+messages go through the same filters as live ones, each chat is split and
+counted in one pass, and is written with a single transaction.
+"""
+import re
+import json
+import logging
+import argparse
+import itertools
+import collections
+import concurrent.futures
+from types import SimpleNamespace
+from markov import chain
+from markov import speech
+from markov.settings import settings
+from markov.filters import message_filter
+
+logger = logging.getLogger(__name__)
+
+# characters read from an export at a time
+READ_SIZE = 1 << 16
+DELIMITER = re.compile(r'[\s,\]}]')
+
+# how the bot api numbers the chats of each type of export
+CHAT_PREFIXES = {
+    'private_group': '-',
+    'private_supergroup': '-100',
+    'public_supergroup': '-100',
+    'private_channel': '-100',
+    'public_channel': '-100'
+}
+
+
+def message_text(message):
+    """The plain text of an exported message, None for service messages."""
+    if message.get('type', 'message') != 'message':
+        return None
+    text = message.get('text')
+    if isinstance(text, list):
+        # formatted texts are split into plain strings and entities
+        text = ''.join(
+            part if isinstance(part, str) else part.get('text', '')
+            for part in text
+        )
+    return text or None
+
+
+class JSONStream:
+    """Walk a json document in a file without loading all of it.
+
+    Objects and arrays are entered an item at a time with ``items`` and
+    ``elements``, and every item has to be consumed, with ``value`` to read
+    it whole or ``skip`` to pass over it, before going on to the next one.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(READ_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            while (
+                self.pos < len(self.buffer) and self.buffer[self.pos].isspace()
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of json')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} in json')
+        self.pos += 1
+
+    def value(self):
+        if self.peek() not in '"[{':
+            # numbers and literals only end at the next delimiter
+            while not DELIMITER.search(self.buffer, self.pos) and self.fill():
+                pass
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(
+                    self.buffer, self.pos
+                )
+                return value
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+
+    def items(self):
+        """Yield the keys of an object, leaving the stream at their values."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self.pos += 1
+
+    def elements(self):
+        """Yield once per element of an array, leaving the stream at it."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+
+    def skip(self):
+        char = self.peek()
+        if char == '{':
+            for _ in self.items():
+                self.skip()
+        elif char == '[':
+            for _ in self.elements():
+                self.skip()
+        else:
+            self.value()
+
+
+def read_chats(stream, chat_id=None):
+    """Yield the id and texts of the chats of the object ``stream`` is at.
+
+    That is the object itself, for the export of a single chat, or the
+    chats listed in it, for the export of a whole account.
+    """
+    chat, texts, account = {}, [], False
+    for key in stream.items():
+        if key == 'chats':
+            account = True
+            for name in stream.items():
+                if name != 'list':
+                    stream.skip()
+                    continue
+                for _ in stream.elements():
+                    yield from read_chats(stream, chat_id)
+        elif key == 'messages':
+            for _ in stream.elements():
+                text = message_text(stream.value())
+                if text:
+                    texts.append(text)
+        elif key in ('id', 'type'):
+            chat[key] = stream.value()
+        else:
+            stream.skip()
+    if not account:
+        yield chat_id or CHAT_PREFIXES.get(chat.get('type'), '') + str(
+            chat.get('id')), texts
+
+
+def read_export(f, chat_id=None):
+    """Yield the id and texts of every chat of a Telegram Desktop export.
+
+    The export is read from the file ``f`` a chat at a time, and is either
+    the export of a single chat or of a whole account.
+    """
+    yield from read_chats(JSONStream(f), chat_id)
+
+
+def read_file(path, chat_id=None):
+    """Yield the chats of a json export, or of a text file as ``chat_id``.
+
+    Every line of a text file is a message.
+    """
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            yield from read_export(f, chat_id)
+        return
+    if not chat_id:
+        raise ValueError(f'a chat id is needed to import {path}')
+    with open(path, encoding='utf-8') as f:
+        yield chat_id, [line.rstrip('\n') for line in f if line.strip()]
+
+
+def accepted(chat_id, text):
+    """Whether the bot would have learnt from a message."""
+    message = SimpleNamespace(text=text, chat=SimpleNamespace(id=chat_id))
+    return not text.startswith('/') and message_filter(message)
+
+
+def build_chat(chat_id, texts):
+    """Split the messages of a chat and add up their transitions.
+
+    With ``MODEL_LANG`` set, the messages are all tagged up front in a
+    batch, rather than by a pipeline call each.
+    """
+    messages, counts = [], {}
+    languages = [speech.message_language(chat_id, text) for text in texts]
+    runs = [None] * len(texts)
+    if settings.MODEL_LANG:
+        runs = speech.tag_messages(texts, languages)
+    for text, language, tokens in zip(texts, languages, runs):
+        if settings.MODEL_LANG and not tokens:
+            continue
+        model = speech.new_model(text, tokens, language=language)
+        if not model:
+            continue
+        messages.append((text, tokens))
+        chain.count_transitions(counts, model.chain.model)
+    return chat_id, messages, counts
+
+
+def build_chats(chats, jobs):
+    """Build the ``(chat_id, texts)`` pairs of ``chats``, in order.
+
+    With more than one job, chats are built in as many processes, reading
+    only a few chats ahead of the one being saved.
+    """
+    if jobs < 2:
+        yield from itertools.starmap(build_chat, chats)
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for chat in chats:
+            pending.append(executor.submit(build_chat, *chat))
+            if len(pending) > jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_chats(chats, jobs=1):
+    """Build and save the ``(chat_id, texts)`` pairs of ``chats``."""
+    for chat_id, messages, counts in build_chats(chats, jobs):
+        if not messages:
+            continue
+        speech.save_model(chat_id, messages, counts)
+        logger.info(
+            f'imported {len(messages)} messages into chat-id:{chat_id}'
+        )
+
+
+def read_chats_of(paths, chat_id=None):
+    """Yield the chats of every file, keeping the messages the bot would."""
+    for path in paths:
+        for key, texts in read_file(path, chat_id):
+            texts = [text for text in texts if accepted(key, text)]
+            if not settings.GROW_CHAIN:
+                # older messages would be trimmed right away
+                texts = texts[-settings.MESSAGE_LIMIT:]
+            yield key, texts
+
+
+def main(argv=None):
+    logging.basicConfig(level=getattr(logging, settings.LOG_LEVEL))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='json exports or text files')
+    parser.add_argument('--chat', '-c', help='chat id to import into')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='chats built in parallel')
+    args = parser.parse_args(argv)
+    import_chats(read_chats_of(args.files, args.chat), args.jobs)
+
+
+if __name__ == '__main__':
+    main()
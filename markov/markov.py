@@ -1,14 +1,71 @@
 import telebot
 import logging
 import functools
+import threading
 from markov import speech
+from markov import metrics
+from cachetools import TTLCache
 from markov.settings import settings
 from markov.filters import message_filter
+from markov.dispatcher import Dispatcher, DispatchingBot
 
 logging.basicConfig(level=getattr(logging, settings.LOG_LEVEL))
 logger = logging.getLogger(__name__)
 
-bot = telebot.TeleBot(settings.TELEGRAM_TOKEN)
+dispatcher = Dispatcher(
+    settings.DISPATCH_WORKERS, settings.DISPATCH_QUEUE_SIZE,
+    settings.DISPATCH_TIMEOUT
+)
+bot = DispatchingBot(settings.TELEGRAM_TOKEN, dispatcher)
+
+if speech.sentences:
+    # only fill sentence pools while no update is waiting
+    speech.sentences.idle = dispatcher.idle
+
+admins = TTLCache(
+    maxsize=settings.ADMIN_CACHE_SIZE, ttl=settings.ADMIN_CACHE_TTL
+)
+admins_lock = threading.Lock()
+
+# longest text telegram accepts in a message
+MAX_MESSAGE_LENGTH = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def bot_username():
+    return bot.get_me().username
+
+
+def chat_admins(chat_id):
+    """Usernames of the administrators of a chat, cached for a while."""
+    with admins_lock:
+        usernames = admins.get(chat_id)
+    if usernames is None:
+        logger.debug(f'fetching administrators for chat-id:{chat_id}')
+        usernames = [
+            u.user.username for u in bot.get_chat_administrators(chat_id)
+        ]
+        with admins_lock:
+            admins[chat_id] = usernames
+    return usernames
+
+
+def forget_admins(chat_id):
+    with admins_lock:
+        admins.pop(str(chat_id), None)
+
+
+def members_changed(update):
+    """Forget the admins of a chat whose members changed, from a raw update.
+
+    telebot does not parse these updates, so they are read from the json.
+    """
+    for member in ('chat_member', 'my_chat_member'):
+        if member in update:
+            forget_admins(update[member]['chat']['id'])
+
+
+bot.received = members_changed
 
 
 def admin_required(func):
@@ -18,9 +75,7 @@ def admin_required(func):
         chat_id = str(message.chat.id)
         username_admins = []
         if message.chat.type != 'private':
-            username_admins = [
-                u.user.username for u in bot.get_chat_administrators(chat_id)
-            ]
+            username_admins = chat_admins(chat_id)
         if username in username_admins + settings.ADMIN_USERNAMES:
             return func(message, *args, **kwargs)
         else:
@@ -87,17 +142,33 @@ def get_repo_version(message):
 @confirmation_required
 def flush_cache(message):
     logger.info(f'flush cmd called by chat {message.chat.id}')
-    speech.flush()
+    speech.flush(message.chat)
+
+
+@bot.message_handler(commands=[settings.METRICS_COMMAND])
+@admin_required
+def get_metrics(message):
+    logger.info(f'metrics cmd called by chat {message.chat.id}')
+    # only report a cached model, reading metrics should not load one
+    with speech.models_lock:
+        model = speech.models.get(str(message.chat.id))
+        size = speech.model_size(model) if model else 0
+    report = metrics.render(skip={speech.model_sizes.name})
+    report += f'{speech.model_sizes.name} {size}\n'
+    # only the bucketless lines fit in a telegram message
+    lines = [line for line in report.splitlines() if '_bucket' not in line]
+    bot.reply_to(message, '\n'.join(lines)[:MAX_MESSAGE_LENGTH])
 
 
 @bot.message_handler(commands=[settings.HELP_COMMAND])
 def help(message):
     logger.info(f'help cmd called by chat {message.chat.id}')
-    username = bot.get_me().username
+    username = bot_username()
     sentence_command = settings.SENTENCE_COMMAND
     remove_command = settings.REMOVE_COMMAND
     version_command = settings.VERSION_COMMAND
     flush_command = settings.FLUSH_COMMAND
+    metrics_command = settings.METRICS_COMMAND
     start_command = settings.START_COMMAND
     help_command = settings.HELP_COMMAND
 
@@ -108,13 +179,15 @@ def help(message):
         "{remove_command}: {username} will remove messages from chat.\n"
         "{version_command}: {username} will state its current version.\n"
         "{flush_command}: {username} will clear its cache.\n"
+        "{metrics_command}: {username} will report its metrics.\n"
         "{start_command}: {username} will display quickstart info.\n"
         "{help_command}: {username} will print this help message!"
     )
     output_text = help_text.format(
         username=username, sentence_command=sentence_command,
         remove_command=remove_command, version_command=version_command,
-        flush_command=flush_command, start_command=start_command,
+        flush_command=flush_command, metrics_command=metrics_command,
+        start_command=start_command,
         help_command=help_command
     )
     bot.reply_to(message, output_text)
@@ -137,10 +210,15 @@ def handle_message(message):
     except ValueError as er:
         logger.error(er)
         return
-    if f'@{bot.get_me().username}' in message.text:
+    if f'@{bot_username()}' in message.text:
         generate_sentence(message, reply=True)
 
 
+def serve_metrics():
+    if settings.METRICS_PORT:
+        metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)
+
+
 def notify_admin(message):
     if settings.ADMIN_CHAT_ID and message:
         bot.send_message(settings.ADMIN_CHAT_ID, message)
@@ -149,4 +227,6 @@ def notify_admin(message):
 
 if __name__ == '__main__':
     notify_admin('starting the bot')
+    bot_username()
+    serve_metrics()
     bot.polling(none_stop=True)
@@ -0,0 +1,173 @@
+import time
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+registry = []
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """A named family of values, one per set of labels."""
+
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{label_text(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    Values can be set, or read from ``collect`` on every render, which
+    returns them as a dict keyed by label dicts turned into sorted tuples.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, collect=None):
+        super().__init__(name, help)
+        self.collect = collect
+
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        for labels, value in self.collect().items():
+            yield self.name, labels, value
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(tuple(sorted(labels.items())), None)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(
+                key, [0] * (len(self.buckets) + 2)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in a block, or in a decorated call."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for name, labels, counts in super().samples():
+            bounds = [str(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                yield f'{name}_bucket', labels + (('le', bound),), count
+            yield f'{name}_count', labels, counts[-2]
+            yield f'{name}_sum', labels, counts[-1]
+
+
+def render(skip=()):
+    """All metrics in the Prometheus text format, but those in ``skip``."""
+    return '\n'.join(
+        metric.render() for metric in registry if metric.name not in skip
+    ) + '\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(host, port):
+    """Serve the metrics on ``/metrics`` from a background thread."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f'serving metrics on {host}:{server.server_port}')
+    return server
+
+
+stage_seconds = Histogram(
+    'markov_stage_seconds', 'Seconds spent in each stage of the bot'
+)
+model_cache = Counter(
+    'markov_model_cache_total', 'Model cache lookups by result'
+)
+sentence_rejections = Counter(
+    'markov_sentence_rejections_total',
+    'Generated sentences rejected for overlapping the corpus'
+)
+generation_failures = Counter(
+    'markov_generation_failures_total',
+    'Sentence requests that ran out of tries'
+)
+sentence_pool = Counter(
+    'markov_sentence_pool_total', 'Sentences taken from the pool by result'
+)
@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+import collections
+from cachetools import LRUCache
+from markov.background import Background
+
+logger = logging.getLogger(__name__)
+
+# seconds between looks for pools to refill
+REFILL_INTERVAL = 1
+
+
+class ChatPool:
+    def __init__(self):
+        self.version = 0
+        self.sentences = collections.deque()
+        self.exhausted = False
+
+
+class SentencePool(Background):
+    """Sentences generated ahead of time for the chats that ask for them.
+
+    ``generate(chat_id)`` makes one sentence, or None, and raises KeyError
+    when it has nothing to make one from yet, in which case the chat is
+    tried again later. A chat gets a pool
+    the first time it asks for a sentence, and a background thread keeps
+    it topped up to ``size`` sentences whenever ``idle()`` says the bot has
+    nothing better to do. A sentence is dropped once it is ``ttl`` seconds
+    old, or once its chat changed more than ``changes`` times since it was
+    generated. Pools are kept for the ``chats`` chats that asked last.
+    """
+
+    def __init__(self, generate, size, ttl, changes, chats):
+        super().__init__()
+        self.generate = generate
+        self.size = size
+        self.ttl = ttl
+        self.changes = changes
+        self.pools = LRUCache(maxsize=chats)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.idle = lambda: True
+
+    def fresh(self, pool, entry):
+        version, created, _ = entry
+        return (
+            pool.version - version <= self.changes and
+            time.monotonic() - created <= self.ttl
+        )
+
+    def take(self, chat_id):
+        """Pop a sentence of the chat, or None if it has none ready."""
+        with self.lock:
+            pool = self.pools.get(chat_id)
+            if pool is None:
+                pool = self.pools[chat_id] = ChatPool()
+            sentence = None
+            while pool.sentences and sentence is None:
+                entry = pool.sentences.popleft()
+                if self.fresh(pool, entry):
+                    sentence = entry[2]
+        self.start()
+        self.wake.set()
+        return sentence
+
+    def changed(self, chat_id):
+        """Age the sentences of a chat whose chain changed."""
+        with self.lock:
+            pool = self.pools.get(chat_id)
+            if pool is not None:
+                pool.version += 1
+                pool.exhausted = False
+
+    def discard(self, chat_id):
+        with self.lock:
+            self.pools.pop(chat_id, None)
+
+    def wanting(self):
+        """The chats whose pool is not full, dropping stale sentences."""
+        with self.lock:
+            chats = []
+            for chat_id, pool in self.pools.items():
+                fresh = [e for e in pool.sentences if self.fresh(pool, e)]
+                pool.sentences = collections.deque(fresh)
+                if len(fresh) < self.size and not pool.exhausted:
+                    chats.append(chat_id)
+            return chats
+
+    def refill(self, chat_id):
+        """Add a sentence to the pool of a chat; False if none was made."""
+        with self.lock:
+            pool = self.pools.get(chat_id)
+            if pool is None or len(pool.sentences) >= self.size:
+                return False
+            version = pool.version
+        try:
+            sentence = self.generate(chat_id)
+        except KeyError:
+            return False
+        with self.lock:
+            if self.pools.get(chat_id) is not pool:
+                return False
+            if sentence is None:
+                # wait for new messages before trying again
+                pool.exhausted = pool.version == version
+                return False
+            pool.sentences.append((version, time.monotonic(), sentence))
+            return True
+
+    def run(self):
+        while True:
+            self.wake.wait(REFILL_INTERVAL)
+            self.wake.clear()
+            for chat_id in self.wanting():
+                try:
+                    while self.idle() and self.refill(chat_id):
+                        pass
+                except Exception:
+                    logger.exception(
+                        f'could not refill sentences of chat-id:{chat_id}'
+                    )
@@ -1,6 +1,12 @@
 from decouple import config, Csv
 
 
+def patterns(value):
+    """Parse ``name=regex`` pairs separated by semicolons."""
+    pairs = (pair.partition('=') for pair in value.split(';'))
+    return {name.strip(): regex for name, _, regex in pairs if name.strip()}
+
+
 class Settings:
     TELEGRAM_TOKEN = config('TELEGRAM_TOKEN', default='')
     ADMIN_USERNAMES = config('ADMIN_USERNAMES', default='', cast=Csv())
@@ -8,20 +14,62 @@ class Settings:
     REMOVE_COMMAND = config('REMOVE_COMMAND', default='remove')
     VERSION_COMMAND = config('VERSION_COMMAND', default='version')
     FLUSH_COMMAND = config('FLUSH_COMMAND', default='flush')
+    METRICS_COMMAND = config('METRICS_COMMAND', default='metrics')
     HELP_COMMAND = config('HELP_COMMAND', default='help')
     START_COMMAND = config('START_COMMAND', default='start')
     DATABASE_URL = config('DATABASE_URL', default='sqlite:///:memory:')
     MODEL_CACHE_TTL = config('MODEL_CACHE_TTL', default='300', cast=int)
+    ADMIN_CACHE_TTL = config('ADMIN_CACHE_TTL', default=300, cast=int)
+    ADMIN_CACHE_SIZE = config('ADMIN_CACHE_SIZE', default=10000, cast=int)
+    MODEL_CACHE_SIZE = config('MODEL_CACHE_SIZE', default=1000000, cast=int)
     COMMIT_HASH = config('HEROKU_SLUG_COMMIT', default='not set')
     MESSAGE_LIMIT = config('MESSAGE_LIMIT', default='5000', cast=int)
     LOG_LEVEL = config('LOG_LEVEL', default='INFO')
     ADMIN_CHAT_ID = config('ADMIN_CHAT_ID', default='')
     FILTERS = config('FILTERS', default='', cast=Csv())
+    FILTER_PATTERNS = config('FILTER_PATTERNS', default='', cast=patterns)
+    FILTER_KEYWORDS = config('FILTER_KEYWORDS', default='', cast=Csv())
     MODEL_LANG = config('MODEL_LANG', default='', cast=Csv())
+    NLP_DISABLE = config('NLP_DISABLE', default='ner', cast=Csv())
+    NLP_BATCH_SIZE = config('NLP_BATCH_SIZE', default=256, cast=int)
+    NLP_PROCESSES = config('NLP_PROCESSES', default=1, cast=int)
+    LANGUAGE_SAMPLE = config('LANGUAGE_SAMPLE', default=20, cast=int)
+    LANGUAGE_STATS_SIZE = config(
+        'LANGUAGE_STATS_SIZE', default=10000, cast=int
+    )
     RETAIN_ORIG = config('RETAIN_ORIG', default=True, cast=bool)
     MAX_OVERLAP_RATIO = config('MAX_OVERLAP_RATIO', default=0.7, cast=float)
     TRIES = config('TRIES', default=50, cast=int)
+    SENTENCE_POOL_SIZE = config('SENTENCE_POOL_SIZE', default=0, cast=int)
+    SENTENCE_POOL_TTL = config('SENTENCE_POOL_TTL', default=600, cast=float)
+    SENTENCE_POOL_CHANGES = config(
+        'SENTENCE_POOL_CHANGES', default=20, cast=int
+    )
+    SENTENCE_POOL_CHATS = config('SENTENCE_POOL_CHATS', default=1000, cast=int)
     GROW_CHAIN = config('GROW_CHAIN', default=False, cast=bool)
+    MAX_CHAIN_STATES = config('MAX_CHAIN_STATES', default=0, cast=int)
+    PRUNE_MIN_COUNT = config('PRUNE_MIN_COUNT', default=2, cast=int)
+    PRUNE_AGE = config('PRUNE_AGE', default=1000, cast=int)
+    COMPACT_INTERVAL = config('COMPACT_INTERVAL', default=60, cast=float)
+    CHAIN_SNAPSHOTS = config('CHAIN_SNAPSHOTS', default=True, cast=bool)
+    SNAPSHOT_INTERVAL = config('SNAPSHOT_INTERVAL', default=60, cast=float)
+    CHAIN_FILES_DIR = config('CHAIN_FILES_DIR', default='')
+    CHAIN_FILES_DELAY = config('CHAIN_FILES_DELAY', default=30, cast=float)
+    CHAIN_FILES_OPEN = config('CHAIN_FILES_OPEN', default=100, cast=int)
+    COMPACT_CHAIN = config('COMPACT_CHAIN', default=False, cast=bool)
+    WRITE_BEHIND = config('WRITE_BEHIND', default=False, cast=bool)
+    FLUSH_INTERVAL = config('FLUSH_INTERVAL', default=5, cast=float)
+    FLUSH_SIZE = config('FLUSH_SIZE', default=100, cast=int)
+    SHARDS = config('SHARDS', default=2, cast=int)
+    DISPATCH_WORKERS = config('DISPATCH_WORKERS', default=4, cast=int)
+    DISPATCH_QUEUE_SIZE = config('DISPATCH_QUEUE_SIZE', default=1000, cast=int)
+    DISPATCH_TIMEOUT = config('DISPATCH_TIMEOUT', default=10, cast=float)
+    WEBHOOK_URL = config('WEBHOOK_URL', default='')
+    WEBHOOK_PATH = config('WEBHOOK_PATH', default=f'/{TELEGRAM_TOKEN}')
+    WEBHOOK_HOST = config('WEBHOOK_HOST', default='0.0.0.0')
+    WEBHOOK_PORT = config('PORT', default=8443, cast=int)
+    METRICS_HOST = config('METRICS_HOST', default='127.0.0.1')
+    METRICS_PORT = config('METRICS_PORT', default=0, cast=int)
 
 
 settings = Settings()
@@ -0,0 +1,275 @@
+import time
+import queue
+import bisect
+import signal
+import hashlib
+import logging
+import telebot
+import multiprocessing
+from types import SimpleNamespace
+from markov.settings import settings
+from markov.dispatcher import ALLOWED_UPDATES
+
+logger = logging.getLogger(__name__)
+
+# points each shard takes on the hash ring
+REPLICAS = 100
+
+# seconds a getUpdates call waits for updates, and before retrying one
+POLL_TIMEOUT = 20
+RETRY_DELAY = 1
+
+# seconds between checks for dead workers while waiting on a resize
+ACK_TIMEOUT = 1
+
+# keys of the updates that carry a chat, and where the chat is in them
+CHAT_PATHS = [
+    ('message', 'chat'), ('edited_message', 'chat'),
+    ('channel_post', 'chat'), ('edited_channel_post', 'chat'),
+    ('callback_query', 'message', 'chat'),
+    ('chat_member', 'chat'), ('my_chat_member', 'chat')
+]
+
+
+def digest(value):
+    """A 64 bit hash of a string that is the same in every process."""
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of chat ids onto ``shards`` shards.
+
+    Every shard is placed at ``replicas`` points of a ring of hashes and a
+    key belongs to the shard of the first point after its own hash. Going
+    from N to N + 1 shards, or back, only moves the keys of the shard that
+    is added or removed, about 1 / (N + 1) of them.
+    """
+
+    def __init__(self, shards, replicas=REPLICAS):
+        if shards < 1:
+            raise ValueError('there must be at least one shard')
+        points = sorted(
+            (digest(f'{shard}:{i}'), shard)
+            for shard in range(shards) for i in range(replicas)
+        )
+        self.size = shards
+        self.hashes = [value for value, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, key):
+        i = bisect.bisect(self.hashes, digest(str(key)))
+        return self.shards[i % len(self.shards)]
+
+
+def update_chat(update):
+    """The id of the chat a raw update belongs to, if any."""
+    for path in CHAT_PATHS:
+        value = update
+        for name in path:
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is not None:
+            return value.get('id')
+
+
+class Worker:
+    """Handle the updates of one shard with the bot handlers.
+
+    The bot is imported here, in the worker process, so every worker has
+    its own model cache and only fills it with the chats of its shard.
+    """
+
+    def __init__(self, index, shards):
+        from markov import markov
+        self.index = index
+        self.ring = HashRing(shards)
+        self.markov = markov
+        markov.bot_username()
+
+    def handle(self, update):
+        self.markov.members_changed(update)
+        self.markov.bot.process_new_updates(
+            [telebot.types.Update.de_json(update)]
+        )
+
+    def settle(self):
+        """Finish the queued updates and write any buffered ones."""
+        from markov import speech
+        self.markov.bot.dispatcher.join()
+        if speech.buffer:
+            speech.buffer.flush()
+
+    def rebalance(self, shards):
+        """Let go of the chats that move to another shard.
+
+        Their updates are done and written first, so the worker taking them
+        over loads them from the database as they are.
+        """
+        from markov import speech
+        self.settle()
+        self.ring = HashRing(shards)
+        with speech.models_lock:
+            chats = set(speech.models)
+        with speech.chat_languages_lock:
+            chats.update(speech.chat_languages)
+        if speech.sentences:
+            with speech.sentences.lock:
+                chats.update(speech.sentences.pools)
+        for chat_id in chats:
+            if self.ring.shard(chat_id) != self.index:
+                speech.flush(SimpleNamespace(id=chat_id))
+
+    def stop(self):
+        self.settle()
+
+
+def work(index, shards, tasks, acks, worker=Worker, args=()):
+    """Run a worker process, feeding it the tasks of its queue."""
+    # the router stops the workers once they are done with their updates
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    handler = worker(index, shards, *args)
+    while True:
+        task = tasks.get()
+        if task is None:
+            handler.stop()
+            return
+        kind, value = task
+        if kind == 'resize':
+            handler.rebalance(value)
+            acks.put(index)
+            continue
+        try:
+            handler.handle(value)
+        except Exception:
+            logger.exception('error handling update')
+
+
+class Router:
+    """Route raw updates to worker processes by a hash of their chat id.
+
+    Each of the ``shards`` workers is a ``worker(index, shards, *args)``
+    running in its own process. On ``resize`` every worker first lets go of
+    the chats it no longer owns, and routing only switches to the new ring
+    once they all have, so no two workers ever hold the same chat.
+    """
+
+    def __init__(self, shards, worker=Worker, args=()):
+        self.context = multiprocessing.get_context('spawn')
+        self.acks = self.context.Queue()
+        self.worker = worker
+        self.args = args
+        self.workers = []
+        self.ring = HashRing(shards)
+        self.wanted = shards
+
+    def spawn(self, index, shards):
+        tasks = self.context.Queue()
+        process = self.context.Process(
+            target=work, name=f'markov-shard-{index}',
+            args=(index, shards, tasks, self.acks, self.worker, self.args)
+        )
+        process.start()
+        return process, tasks
+
+    def start(self):
+        logger.info(f'starting {self.ring.size} shards')
+        self.workers = [
+            self.spawn(index, self.ring.size)
+            for index in range(self.ring.size)
+        ]
+
+    def check(self):
+        """Restart dead workers and apply a resize asked for meanwhile."""
+        for index, (process, _) in enumerate(self.workers):
+            if not process.is_alive():
+                logger.error(f'shard {index} died, restarting it')
+                self.workers[index] = self.spawn(index, self.ring.size)
+        if self.wanted != self.ring.size:
+            self.resize(self.wanted)
+
+    def route(self, update):
+        chat_id = update_chat(update)
+        index = self.ring.shard('' if chat_id is None else chat_id)
+        self.workers[index][1].put(('update', update))
+
+    def resize(self, shards):
+        ring = HashRing(shards)
+        self.wanted = shards
+        logger.info(f'resizing from {self.ring.size} to {shards} shards')
+        for _, tasks in self.workers:
+            tasks.put(('resize', shards))
+        waiting = set(range(len(self.workers)))
+        while waiting:
+            try:
+                waiting.discard(self.acks.get(timeout=ACK_TIMEOUT))
+            except queue.Empty:
+                dead = [
+                    index for index in waiting
+                    if not self.workers[index][0].is_alive()
+                ]
+                for index in dead:
+                    # a worker started now holds nothing to let go of
+                    logger.error(f'shard {index} died while resizing')
+                    waiting.discard(index)
+                    if index < shards:
+                        self.workers[index] = self.spawn(index, shards)
+        while len(self.workers) > shards:
+            process, tasks = self.workers.pop()
+            tasks.put(None)
+            process.join()
+        while len(self.workers) < shards:
+            self.workers.append(self.spawn(len(self.workers), shards))
+        self.ring = ring
+
+    def stop(self):
+        for _, tasks in self.workers:
+            tasks.put(None)
+        for process, _ in self.workers:
+            process.join()
+        self.workers = []
+
+
+def poll(router):
+    """Fetch updates with long polling and route them, forever."""
+    offset = None
+    while True:
+        router.check()
+        try:
+            updates = telebot.apihelper.get_updates(
+                settings.TELEGRAM_TOKEN, offset, None, POLL_TIMEOUT,
+                ALLOWED_UPDATES
+            )
+        except Exception as er:
+            logger.error(f'could not get updates: {er}')
+            time.sleep(RETRY_DELAY)
+            continue
+        for update in updates:
+            router.route(update)
+            offset = update['update_id'] + 1
+
+
+def main():
+    router = Router(settings.SHARDS)
+
+    def grow(signum, frame):
+        router.wanted += 1
+
+    def shrink(signum, frame):
+        router.wanted = max(router.wanted - 1, 1)
+
+    def terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    # the same signals gunicorn uses to add and remove workers
+    signal.signal(signal.SIGTTIN, grow)
+    signal.signal(signal.SIGTTOU, shrink)
+    # heroku stops dynos with SIGTERM, let the workers finish first
+    signal.signal(signal.SIGTERM, terminate)
+    router.start()
+    try:
+        poll(router)
+    finally:
+        router.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,171 @@
 import re
-import json
-import spacy
-import dataset
+import pycld2
 import logging
-import operator
+import functools
+import itertools
+import collections
 import markovify
-from attrdict import AttrDict
+import threading
+import contextlib
+from markov import storage
+from markov import metrics
 from markov.settings import settings
-from cachetools.func import ttl_cache
-from spacy_cld import LanguageDetector
+from markov.corpus import OverlapIndex
+from markov.pool import SentencePool
+from markov.chain import Chain, CompactChain, MappedChain
+from markov.chain import count_transitions, update_chain
+from markov.chain import serialize, deserialize
+from markovify.chain import BEGIN
+from cachetools import LRUCache, TTLCache
 
 logger = logging.getLogger(__name__)
 
-# ignore thread checking for sqlite
-engine_config = {
-    'connect_args': {'check_same_thread': False}
-} if settings.DATABASE_URL.startswith('sqlite') else {}
+# messages split at a time when reading a corpus
+CORPUS_CHUNK = 500
 
-db = dataset.connect(
-    settings.DATABASE_URL, engine_kwargs=engine_config
-)['messages']
+
+class Pipelines:
+    """The spaCy pipeline of each configured language, loaded on first use.
+
+    Loading a pipeline (and importing spaCy at all) takes seconds, so it is
+    left until a text in that language has to be parsed. Components listed
+    in ``NLP_DISABLE`` are not loaded.
+    """
+
+    def __init__(self, languages):
+        self.languages = list(languages)
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def load(self, lang):
+        import spacy
+        logger.info(f'loading {lang} spacy model')
+        return spacy.load(lang, disable=settings.NLP_DISABLE)
+
+    def __getitem__(self, lang):
+        with self.lock:
+            while lang not in self.loaded:
+                try:
+                    self.loaded[lang] = self.load(lang)
+                except OSError:
+                    logger.error(f'{lang} spacy module not found')
+                    self.languages.remove(lang)
+                    if not self.languages:
+                        raise KeyError(lang)
+                    # fall back to the first language left
+                    lang = self.languages[0]
+            return self.loaded[lang]
 
 
 def load_nlp_models(languages=[]):
-    nlp_models = None
-    if languages:
-        nlp_models = AttrDict({'languages': [], 'processors': []})
-        ld = LanguageDetector()
-        for lang in languages:
-            try:
-                model = spacy.load(lang)
-            except OSError:
-                logger.error(f'{lang} spacy module not found')
-                continue
-            model.add_pipe(ld)
-            nlp_models['languages'].append(lang)
-            nlp_models['processors'].append((lang, model))
-        if not nlp_models['languages']:
-            nlp_models = None
-    return nlp_models
+    return Pipelines(languages) if languages else None
 
 
 nlp = load_nlp_models(settings.MODEL_LANG)
 
 
-def process_text(text):
+@metrics.stage_seconds.time(stage='nlp')
+def process_text(text, language=None):
     logger.debug('performing n.l.p.')
     if not nlp:
         return text
-    lang, proc = nlp.processors[0]
-    doc = proc(text)
-    scores = doc._.language_scores.items()
-    if scores:
-        guess = max(scores, key=operator.itemgetter(1))[0]
-        if guess != lang and guess in nlp.languages:
-            lang, proc = nlp.processors[nlp.languages.index(guess)]
-            doc = proc(text)
-    return doc
-
-
-class PosifiedText(markovify.NewlineText):
+    return nlp[language or detect_language(text)](text)
+
+
+def detect_language(text):
+    """Guess which of the loaded languages a text is in, using cld alone."""
+    try:
+        _, _, details = pycld2.detect(text)
+    except pycld2.error:
+        details = []
+    scores = [(score, lang) for _, lang, score, _ in details if lang != 'un']
+    guess = max(scores)[1] if scores else None
+    return guess if guess in nlp.languages else nlp.languages[0]
+
+
+@metrics.stage_seconds.time(stage='nlp')
+def process_texts(texts, language=None):
+    """Run many texts through the nlp pipelines in batches.
+
+    Each text is routed to the pipeline of its language first, using cld on
+    the raw text unless ``language`` is known, and every pipeline then
+    parses its texts with ``pipe``.
+    """
+    texts = list(texts)
+    if not nlp:
+        return texts
+    logger.debug(f'performing n.l.p. on {len(texts)} texts')
+    routes = {}
+    for i, text in enumerate(texts):
+        lang = language or detect_language(text)
+        routes.setdefault(lang, []).append(i)
+    docs = [None] * len(texts)
+    for lang, indexes in routes.items():
+        parsed = nlp[lang].pipe(
+            (texts[i] for i in indexes),
+            batch_size=settings.NLP_BATCH_SIZE,
+            n_process=settings.NLP_PROCESSES
+        )
+        for i, doc in zip(indexes, parsed):
+            docs[i] = doc
+    return docs
+
+
+class Text(markovify.NewlineText):
+    """A NewlineText that checks overlap against an n-gram index.
+
+    ``language`` is the language of the corpus, when it is already known.
+    ``corpus``, a callable returning the word runs of the corpus, is read
+    lazily, on the first overlap check, instead of ``parsed_sentences``.
+    """
+
+    def __init__(self, *args, language=None, corpus=None, **kwargs):
+        self.language = language
+        super().__init__(*args, **kwargs)
+        if corpus is not None:
+            self.retain_original = True
+            self.overlap = OverlapIndex(
+                source=lambda: map(self.surface, corpus())
+            )
+            self.rejoined_text = ''
+        elif self.retain_original:
+            sentences = map(self.surface, self.parsed_sentences)
+            self.overlap = OverlapIndex(sentences)
+            # the index replaces markovify's scan over the joined corpus
+            self.rejoined_text = ''
+
+    def surface(self, words):
+        return words
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap):
+        overlap_ratio = int(round(max_overlap_ratio * len(words)))
+        overlap_max = min(max_overlap, overlap_ratio)
+        if self.overlap.contains(self.surface(words), overlap_max + 1):
+            metrics.sentence_rejections.inc()
+            return False
+        return True
+
+
+class PosifiedText(Text):
+    def surface(self, words):
+        return [w.split('::')[0] for w in words]
+
+    def generate_corpus(self, text):
+        if isinstance(text, str):
+            sentences = self.sentence_split(text)
+        else:
+            sentences = itertools.chain.from_iterable(
+                map(self.sentence_split, text))
+        passing = filter(self.test_sentence_input, sentences)
+        return map(self.tag_words, process_texts(passing, self.language))
+
     def word_split(self, sentence):
         logger.debug('spliting sentece into words')
-        return ['::'.join((w.text, w.pos_, w.dep_))
-                for w in process_text(sentence)]
+        return self.tag_words(process_text(sentence, self.language))
+
+    @staticmethod
+    def tag_words(doc):
+        return ['::'.join((w.text, w.pos_, w.dep_)) for w in doc]
 
     def word_join(self, words):
         logger.debug('joining words into sentence')
@@ -71,27 +173,277 @@ class PosifiedText(markovify.NewlineText):
         return re.sub(r'\s([!?.,;"](?:\s|$))', r'\1', sentence)
 
 
-def new_model(text):
+def model_class():
+    return PosifiedText if settings.MODEL_LANG else Text
+
+
+def chain_class():
+    return CompactChain if settings.COMPACT_CHAIN else Chain
+
+
+@metrics.stage_seconds.time(stage='new_model')
+def new_model(text, tokens=None, language=None):
+    """Build a model from a text, or from the word runs it was split into."""
     logger.debug('creating a new model')
-    Cls = PosifiedText if settings.MODEL_LANG else markovify.NewlineText
+    Cls = model_class()
     model = None
     try:
-        model = Cls(re.sub(r'["\']', '', text),
-                    retain_original=settings.RETAIN_ORIG)
+        if tokens:
+            model = Cls(None, parsed_sentences=tokens, language=language)
+        else:
+            model = Cls(re.sub(r'["\']', '', text), language=language)
     except KeyError:
         logger.error(f'cannot create a chain from {text}')
     return model
 
 
-@ttl_cache(ttl=settings.MODEL_CACHE_TTL)
+def message_sentences(text):
+    """The sentences of a message that ``new_model`` would tag.
+
+    Like ``Text``, quotes are dropped, the message is split at newlines and
+    the sentences markovify rejects as malformed are skipped.
+    """
+    text = re.sub(r'["\']', '', text)
+    return [
+        sentence for sentence in re.split(r'\s*\n\s*', text)
+        if sentence.strip() and not Text.reject_pat.search(sentence)
+    ]
+
+
+def tag_messages(texts, languages):
+    """Split and tag many messages, in one batch per language.
+
+    Returns the word runs of every message, in order, for ``new_model`` to
+    build their models from without tagging them one at a time.
+    """
+    runs = [[] for _ in texts]
+    batches = {}
+    for i, (text, language) in enumerate(zip(texts, languages)):
+        for sentence in message_sentences(text):
+            batches.setdefault(language, []).append((i, sentence))
+    for language, batch in batches.items():
+        docs = process_texts((sentence for _, sentence in batch), language)
+        for (i, _), doc in zip(batch, docs):
+            runs[i].append(PosifiedText.tag_words(doc))
+    return runs
+
+
+def message_tokens(messages, language=None):
+    """Collect the word runs of stored ``(text, tokens)`` messages.
+
+    Only messages stored without tokens are split again, all at once.
+    """
+    tokens, untagged = [], []
+    for text, runs in messages:
+        if runs:
+            tokens.extend(runs)
+        else:
+            untagged.append(text)
+    if untagged:
+        logger.debug(f'splitting {len(untagged)} untagged messages')
+        model = new_model('\n'.join(untagged), language=language)
+        if model:
+            tokens.extend(model.parsed_sentences)
+    return tokens
+
+
+def stored_sentences(chat_id, language=None):
+    """Stream the word runs of a chat's messages, a chunk at a time."""
+    with buffer.flush_lock if buffer else contextlib.nullcontext():
+        pending = buffer.pending(chat_id)[0] if buffer else []
+        messages = itertools.chain(storage.iter_messages(chat_id), pending)
+        with metrics.stage_seconds.time(stage='load_corpus'):
+            while True:
+                chunk = list(itertools.islice(messages, CORPUS_CHUNK))
+                if not chunk:
+                    break
+                yield from message_tokens(chunk, language)
+
+
+chat_languages = LRUCache(maxsize=settings.LANGUAGE_STATS_SIZE)
+chat_languages_lock = threading.Lock()
+
+
+def chat_language(chat_id):
+    """The language of a chat, once enough messages say it only has one."""
+    with chat_languages_lock:
+        counts = chat_languages.get(chat_id)
+        if counts and len(counts) == 1:
+            (lang, count), = counts.items()
+            if count >= settings.LANGUAGE_SAMPLE:
+                return lang
+
+
+def message_language(chat_id, text):
+    """Detect the language of a message, unless its chat is monolingual."""
+    if not nlp:
+        return None
+    lang = chat_language(chat_id)
+    if lang is None:
+        lang = detect_language(text)
+        with chat_languages_lock:
+            counts = chat_languages.setdefault(chat_id, collections.Counter())
+            counts[lang] += 1
+    return lang
+
+
+def model_size(model):
+    return len(model.chain)
+
+
+models = TTLCache(
+    maxsize=settings.MODEL_CACHE_SIZE, ttl=settings.MODEL_CACHE_TTL,
+    getsizeof=model_size
+)
+models_lock = threading.RLock()
+
+
+def cached_model_sizes():
+    with models_lock:
+        return {
+            (('chat_id', chat_id),): model_size(model)
+            for chat_id, model in models.items()
+        }
+
+
+model_sizes = metrics.Gauge(
+    'markov_model_size', 'Transitions in the cached model of each chat',
+    collect=cached_model_sizes
+)
+
+
+def cache_model(chat_id, model):
+    with models_lock:
+        try:
+            models[chat_id] = model
+        except ValueError:
+            logger.debug(f'model for chat-id:{chat_id} is too large to cache')
+            models.pop(chat_id, None)
+
+
+def read_chain(chat_id):
+    """Load the chain model of a chat, from its snapshot if up to date.
+
+    Outdated snapshots are rebuilt later, in the background.
+    """
+    if not snapshots:
+        return storage.load_chain(chat_id)
+    seq = storage.last_seq(chat_id)
+    snapshot = storage.load_snapshot(chat_id)
+    if snapshot and snapshot[0] == seq:
+        try:
+            return deserialize(snapshot[1])
+        except ValueError as er:
+            logger.error(f'cannot read snapshot of chat-id:{chat_id}: {er}')
+    model = storage.load_chain(chat_id)
+    if model and seq:
+        snapshots.mark(chat_id)
+    return model
+
+
+# compaction changes a chain without a new seq, so it must not run while
+# a snapshot of the old chain is taken and tagged with that seq
+snapshot_lock = threading.Lock()
+
+
+def write_snapshot(chat_id):
+    """Snapshot the chain of a chat as of its last message."""
+    with snapshot_lock:
+        seq = storage.last_seq(chat_id)
+        model = storage.load_chain(chat_id)
+        if model and seq:
+            storage.save_snapshot(chat_id, seq, serialize(model))
+
+
+snapshots = storage.Deferred(
+    write_snapshot, settings.SNAPSHOT_INTERVAL, 'snapshot'
+) if settings.CHAIN_SNAPSHOTS else None
+
+
+def chain_version(chat_id):
+    """The last message seq of a chat and its chain model as of that seq."""
+    return storage.last_seq(chat_id), read_chain(chat_id)
+
+
+chain_files = storage.ChainFiles(
+    settings.CHAIN_FILES_DIR, chain_version, settings.CHAIN_FILES_DELAY,
+    settings.CHAIN_FILES_OPEN
+) if settings.CHAIN_FILES_DIR else None
+
+
+def load_model(chat_id):
+    logger.debug(f'loading model for chat-id:{chat_id}')
+    with buffer.flush_lock if buffer else contextlib.nullcontext():
+        pending, counts = buffer.pending(chat_id) if buffer else ([], {})
+        chain = None
+        if chain_files and not counts:
+            with metrics.stage_seconds.time(stage='map_chain'):
+                chain = chain_files.open(chat_id, storage.last_seq(chat_id))
+        if chain is None:
+            with metrics.stage_seconds.time(stage='load_chain'):
+                model = read_chain(chat_id)
+            count_transitions(model, counts)
+            state_size = len(next(iter(model))) if model else 0
+            # sentences cannot start without the begin state
+            if model and (BEGIN,) * state_size in model:
+                with metrics.stage_seconds.time(stage='build_chain'):
+                    chain = chain_class()(None, state_size, model)
+        if chain and (BEGIN,) * chain.state_size in chain:
+            Cls = model_class()
+            language = chat_language(chat_id)
+            corpus = None
+            if settings.RETAIN_ORIG:
+                corpus = functools.partial(stored_sentences, chat_id, language)
+            return Cls(None, state_size=chain.state_size, chain=chain,
+                       corpus=corpus, language=language,
+                       retain_original=settings.RETAIN_ORIG)
+
+
 def get_model(chat):
     logger.debug(f'fetching model for chat-id:{chat.id}')
-    chat_id = str(chat.id)
-    chat_data = db.find_one(chat_id=chat_id) or {}
-    if chat_data.get('chain', ''):
-        Cls = PosifiedText if settings.MODEL_LANG else markovify.NewlineText
-        chain = json.loads(chat_data.get('chain'))
-        return Cls.from_chain(chain, corpus=chat_data.get('text', ''))
+    return chat_model(str(chat.id))
+
+
+def chat_model(chat_id):
+    with models_lock:
+        model = models.get(chat_id)
+    metrics.model_cache.inc(result='miss' if model is None else 'hit')
+    if model is None:
+        model = load_model(chat_id)
+        if model:
+            cache_model(chat_id, model)
+    return model
+
+
+def update_cached_model(chat_id, added=None, removed=None):
+    """Apply an update to the cached model of a chat, if there is one."""
+    with models_lock:
+        model = models.get(chat_id)
+        if model is None:
+            return
+        if isinstance(model.chain, MappedChain):
+            # mapped chains are read only, go on with a copy in memory
+            model.chain = chain_class()(
+                None, model.chain.state_size, model.chain.model
+            )
+        logger.debug(f'updating cached model for chat-id:{chat_id}')
+        update_chain(
+            model.chain, added=added and added.chain,
+            removed=removed and removed.chain
+        )
+        if (BEGIN,) * model.chain.state_size not in model.chain:
+            del models[chat_id]
+            return
+        if getattr(model, 'retain_original', False):
+            update_corpus(model, added=added, removed=removed)
+        cache_model(chat_id, model)
+
+
+def update_corpus(model, added=None, removed=None):
+    if removed:
+        model.overlap.remove(removed.overlap.sentences)
+    if added:
+        model.overlap.add(added.overlap.sentences)
 
 
 def update_model(chat, message):
@@ -100,50 +452,144 @@ def update_model(chat, message):
     if not message:
         raise ValueError('message cannot be empty')
     logger.debug(f'updating model for chat-id:{chat.id}')
-    model = new_model(message)
+    chat_id = str(chat.id)
+    model = new_model(message, language=message_language(chat_id, message))
     if not model:
         return
-    else:
-        model = model.chain
-    chat_id = str(chat.id)
-    chat_data = db.find_one(chat_id=chat_id) or {}
-    text = '\n'.join([chat_data.get('text', ''), message])
-    if chat_data.get('chain', ''):
-        if settings.GROW_CHAIN:
-            chain = json.loads(chat_data.get('chain'))
-            cur_m = markovify.Chain.from_json(chain)
-            model = markovify.combine([cur_m, model])
-        else:
-            text = '\n'.join(
-                text.splitlines()[-settings.MESSAGE_LIMIT:])
-            model = new_model(text).chain
-    db.upsert({
-        'chat_id': chat_id,
-        'text': text,
-        'chain': json.dumps(model.to_json())
-    }, ['chat_id'])
+    update_cached_model(chat_id, added=model)
+    if sentences:
+        sentences.changed(chat_id)
+    # tagging is the costly part of splitting, so keep the tagged runs
+    tokens = model.parsed_sentences if settings.MODEL_LANG else None
+    if buffer:
+        buffer.add(chat_id, (message, tokens), model.chain.model)
+        return
+    try:
+        save_model(chat_id, [(message, tokens)], model.chain.model)
+    except Exception:
+        flush(chat)
+        raise
+
+
+@metrics.stage_seconds.time(stage='save_model')
+def save_model(chat_id, messages, counts):
+    logger.debug(f'saving model for chat-id:{chat_id}')
+    with storage.db:
+        seq = storage.append_messages(chat_id, messages)
+        storage.count_transitions(chat_id, counts, seen=seq)
+        if not settings.GROW_CHAIN:
+            dropped = storage.trim_messages(chat_id, settings.MESSAGE_LIMIT)
+            tokens = message_tokens(dropped, chat_language(chat_id))
+            removed = new_model(None, tokens) if tokens else None
+            if removed:
+                storage.count_transitions(chat_id, removed.chain.model, -1)
+                update_cached_model(chat_id, removed=removed)
+    if chain_files:
+        chain_files.schedule(chat_id)
+    if compactor:
+        compactor.mark(chat_id)
+
+
+def compact_model(chat_id):
+    """Prune the chain of a chat back under ``MAX_CHAIN_STATES``."""
+    with buffer.flush_lock if buffer else contextlib.nullcontext():
+        with snapshot_lock:
+            compacted = storage.compact_chain(
+                chat_id, settings.MAX_CHAIN_STATES, settings.PRUNE_MIN_COUNT,
+                settings.PRUNE_AGE
+            )
+        if not compacted:
+            return
+        logger.info(f'compacted chain for chat-id:{chat_id}')
+        with models_lock:
+            models.pop(chat_id, None)
+    if chain_files:
+        chain_files.remove(chat_id)
+        chain_files.schedule(chat_id)
+    if sentences:
+        sentences.changed(chat_id)
+
+
+compactor = storage.Compactor(
+    compact_model, settings.COMPACT_INTERVAL
+) if settings.MAX_CHAIN_STATES else None
+
+
+def evict_model(chat_id):
+    with models_lock:
+        models.pop(chat_id, None)
+
+
+buffer = storage.WriteBuffer(
+    save_model, settings.FLUSH_INTERVAL, settings.FLUSH_SIZE, evict_model
+) if settings.WRITE_BEHIND else None
 
 
 def delete_model(chat):
     logger.debug(f'deleting model for chat-id:{chat.id}')
     chat_id = str(chat.id)
-    db.delete(chat_id=chat_id)
-    get_model.cache_clear()
+    if buffer:
+        buffer.discard(chat_id)
+    if compactor:
+        compactor.discard(chat_id)
+    if snapshots:
+        snapshots.discard(chat_id)
+    with storage.db:
+        storage.delete_messages(chat_id)
+        storage.delete_chain(chat_id)
+    if chain_files:
+        chain_files.remove(chat_id)
+    flush(chat)
 
 
-def flush():
-    logger.debug('cleaning up models\' cache')
-    get_model.cache_clear()
+def flush(chat):
+    logger.debug(f'cleaning up model cache for chat-id:{chat.id}')
+    with models_lock:
+        models.pop(str(chat.id), None)
+    if sentences:
+        sentences.discard(str(chat.id))
+    with chat_languages_lock:
+        chat_languages.pop(str(chat.id), None)
 
 
-def new_message(chat):
-    logger.debug(f'generating message for chat-id:{chat.id}')
-    model = get_model(chat)
+def cached_sentence(chat_id):
+    """Make a sentence from the cached model of a chat, never loading it.
+
+    Models are loaded and updated by the tasks of their chat alone, so a
+    model loaded here could miss a message saved meanwhile. Raises KeyError
+    when the model is not cached.
+    """
+    with models_lock:
+        model = models[chat_id]
+    return make_sentence(model)
+
+
+def make_sentence(model):
     message = None
     if model:
-        message = model.make_sentence(
-            max_overlap_ratio=settings.MAX_OVERLAP_RATIO,
-            tries=settings.TRIES
-        )
+        with metrics.stage_seconds.time(stage='generate'):
+            message = model.make_sentence(
+                max_overlap_ratio=settings.MAX_OVERLAP_RATIO,
+                tries=settings.TRIES
+            )
+        if message is None:
+            metrics.generation_failures.inc()
+    return message
+
+
+sentences = SentencePool(
+    cached_sentence,
+    settings.SENTENCE_POOL_SIZE, settings.SENTENCE_POOL_TTL,
+    settings.SENTENCE_POOL_CHANGES, settings.SENTENCE_POOL_CHATS
+) if settings.SENTENCE_POOL_SIZE else None
+
+
+def new_message(chat):
+    logger.debug(f'generating message for chat-id:{chat.id}')
+    message = sentences and sentences.take(str(chat.id))
+    if sentences:
+        metrics.sentence_pool.inc(result='miss' if message is None else 'hit')
+    if message is None:
+        message = make_sentence(get_model(chat))
 
     return message or 'i need more data'
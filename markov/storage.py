@@ -0,0 +1,534 @@
+import os
+import json
+import time
+import atexit
+import signal
+import weakref
+import dataset
+import logging
+import threading
+from sqlalchemy import text
+from markov.settings import settings
+from markov import chain
+from markov.background import Background
+from markovify.chain import BEGIN
+
+logger = logging.getLogger(__name__)
+
+# ignore thread checking for sqlite
+engine_config = {
+    'connect_args': {'check_same_thread': False}
+} if settings.DATABASE_URL.startswith('sqlite') else {}
+
+db = dataset.connect(settings.DATABASE_URL, engine_kwargs=engine_config)
+
+UPSERT_TRANSITION = (
+    'INSERT INTO chains (chat_id, state, next_word, count, last_seen) '
+    'VALUES (:chat_id, :state, :next_word, :count, :last_seen) '
+    'ON CONFLICT (chat_id, state, next_word) '
+    'DO UPDATE SET count = chains.count + excluded.count, '
+    'last_seen = COALESCE(excluded.last_seen, chains.last_seen)'
+)
+
+DELETE_EXHAUSTED = (
+    'DELETE FROM chains WHERE chat_id = :chat_id AND state = :state '
+    'AND next_word = :next_word AND count <= 0'
+)
+
+DELETE_CHAIN = 'DELETE FROM chains WHERE chat_id = :chat_id'
+
+COUNT_STATES = (
+    'SELECT COUNT(DISTINCT state) FROM chains WHERE chat_id = :chat_id'
+)
+
+PRUNE_RARE = (
+    'DELETE FROM chains WHERE chat_id = :chat_id AND count < :min_count '
+    'AND COALESCE(last_seen, 0) <= :before AND state != :begin'
+)
+
+EVICT_STATES = (
+    'DELETE FROM chains WHERE chat_id = :chat_id AND state IN ('
+    'SELECT state FROM chains WHERE chat_id = :chat_id AND state != :begin '
+    'GROUP BY state ORDER BY COALESCE(MAX(last_seen), 0), state '
+    'LIMIT :excess)'
+)
+
+SELECT_SNAPSHOT = (
+    'SELECT seq, data FROM chain_snapshots WHERE chat_id = :chat_id'
+)
+
+UPSERT_SNAPSHOT = (
+    'INSERT INTO chain_snapshots (chat_id, seq, data) '
+    'VALUES (:chat_id, :seq, :data) '
+    'ON CONFLICT (chat_id) '
+    'DO UPDATE SET seq = excluded.seq, data = excluded.data'
+)
+
+DELETE_SNAPSHOT = 'DELETE FROM chain_snapshots WHERE chat_id = :chat_id'
+
+SELECT_CHAIN = (
+    'SELECT state, next_word, count FROM chains WHERE chat_id = :chat_id'
+)
+
+INSERT_MESSAGE = (
+    'INSERT INTO chat_messages (chat_id, seq, text, tokens) '
+    'VALUES (:chat_id, :seq, :text, :tokens)'
+)
+
+LAST_SEQ = 'SELECT MAX(seq) FROM chat_messages WHERE chat_id = :chat_id'
+
+WINDOW_START = (
+    'SELECT MAX(seq) - :limit FROM chat_messages WHERE chat_id = :chat_id'
+)
+
+SELECT_DROPPED = (
+    'SELECT text, tokens FROM chat_messages WHERE chat_id = :chat_id '
+    'AND seq <= :seq ORDER BY seq'
+)
+
+DELETE_DROPPED = (
+    'DELETE FROM chat_messages WHERE chat_id = :chat_id AND seq <= :seq'
+)
+
+DELETE_MESSAGES = 'DELETE FROM chat_messages WHERE chat_id = :chat_id'
+
+SELECT_MESSAGES = (
+    'SELECT text, tokens FROM chat_messages WHERE chat_id = :chat_id '
+    'ORDER BY seq'
+)
+
+# rows fetched per round trip when streaming a chat's messages
+QUERY_STEP = 500
+
+
+def encode_state(state):
+    return json.dumps(list(state))
+
+
+def decode_state(state):
+    return tuple(json.loads(state))
+
+
+# the state every sentence starts from, at markovify's default state size
+BEGIN_STATE = encode_state((BEGIN,) * 2)
+
+
+def count_transitions(chat_id, counts, weight=1, seen=None):
+    """Add ``weight`` times the transitions of a chain model to a chat.
+
+    Each transition is a single ``count = count + n`` upsert, so the cost
+    of an update depends on the size of ``counts`` and not on the size of
+    the chat's chain. Transitions whose count reaches zero are deleted.
+    ``seen`` is the seq of the message that reinforced them, if any.
+    """
+    logger.debug(f'counting transitions for chat-id:{chat_id}')
+    rows = [
+        {
+            'chat_id': chat_id,
+            'state': encode_state(state),
+            'next_word': word,
+            'count': weight * count,
+            'last_seen': seen
+        }
+        for state, follows in counts.items()
+        for word, count in follows.items()
+    ]
+    if not rows:
+        return
+    with db:
+        db.executable.execute(text(UPSERT_TRANSITION), rows)
+        if weight < 0:
+            # only the decremented transitions can have run out
+            db.executable.execute(text(DELETE_EXHAUSTED), rows)
+
+
+def load_chain(chat_id):
+    """Return the chain model (``{state: {word: count}}``) of a chat."""
+    logger.debug(f'loading chain for chat-id:{chat_id}')
+    model = {}
+    for row in db.query(SELECT_CHAIN, chat_id=chat_id):
+        state = decode_state(row['state'])
+        model.setdefault(state, {})[row['next_word']] = row['count']
+    return model
+
+
+def delete_chain(chat_id):
+    logger.debug(f'deleting chain for chat-id:{chat_id}')
+    with db:
+        db.executable.execute(text(DELETE_CHAIN), chat_id=chat_id)
+        db.executable.execute(text(DELETE_SNAPSHOT), chat_id=chat_id)
+
+
+def count_states(chat_id):
+    return db.executable.execute(
+        text(COUNT_STATES), chat_id=chat_id
+    ).scalar()
+
+
+def compact_chain(chat_id, max_states, min_count, age):
+    """Bring the chain of a chat back to at most ``max_states`` states.
+
+    Transitions counted fewer than ``min_count`` times and not reinforced
+    by the last ``age`` messages go first, then the states reinforced
+    least recently. The begin state is always kept, as sentences start
+    from it. The chain snapshot is dropped with them. Returns
+    whether anything had to be removed.
+    """
+    if count_states(chat_id) <= max_states:
+        return False
+    logger.debug(f'compacting chain for chat-id:{chat_id}')
+    with db:
+        before = (last_seq(chat_id) or 0) - age
+        db.executable.execute(
+            text(PRUNE_RARE), chat_id=chat_id, min_count=min_count,
+            before=before, begin=BEGIN_STATE
+        )
+        excess = count_states(chat_id) - max_states
+        if excess > 0:
+            db.executable.execute(
+                text(EVICT_STATES), chat_id=chat_id, excess=excess,
+                begin=BEGIN_STATE
+            )
+        db.executable.execute(text(DELETE_SNAPSHOT), chat_id=chat_id)
+    return True
+
+
+def load_snapshot(chat_id):
+    """Return the ``(seq, data)`` of a chat's chain snapshot, or None."""
+    row = db.executable.execute(
+        text(SELECT_SNAPSHOT), chat_id=chat_id
+    ).first()
+    return (row['seq'], bytes(row['data'])) if row else None
+
+
+def save_snapshot(chat_id, seq, data):
+    """Store a serialized chain, as of the message numbered ``seq``."""
+    logger.debug(f'saving chain snapshot for chat-id:{chat_id}')
+    db.executable.execute(
+        text(UPSERT_SNAPSHOT), chat_id=chat_id, seq=seq, data=data
+    )
+
+
+def encode_tokens(tokens):
+    return None if tokens is None else json.dumps(tokens)
+
+
+def decode_tokens(tokens):
+    return None if tokens is None else json.loads(tokens)
+
+
+def append_messages(chat_id, messages):
+    """Append many ``(text, tokens)`` messages to a chat's log at once.
+
+    Returns the seq of the last message of the chat.
+    """
+    if not messages:
+        return last_seq(chat_id)
+    logger.debug(f'appending {len(messages)} messages for chat-id:{chat_id}')
+    with db:
+        seq = last_seq(chat_id) or 0
+        db.executable.execute(text(INSERT_MESSAGE), [
+            {
+                'chat_id': chat_id,
+                'seq': seq + i,
+                'text': message,
+                'tokens': encode_tokens(tokens)
+            }
+            for i, (message, tokens) in enumerate(messages, 1)
+        ])
+    return seq + len(messages)
+
+
+def last_seq(chat_id):
+    """The number of the last message of a chat, None if there are none.
+
+    Every change to a chain comes with a new message, so this tells
+    whether a snapshot of the chain is still up to date.
+    """
+    return db.executable.execute(text(LAST_SEQ), chat_id=chat_id).scalar()
+
+
+def trim_messages(chat_id, limit):
+    """Keep only the last ``limit`` messages of a chat.
+
+    Returns the text and tokens of the dropped messages, oldest first, so
+    their transitions can be counted out of the chain.
+    """
+    logger.debug(f'trimming messages for chat-id:{chat_id}')
+    seq = db.executable.execute(
+        text(WINDOW_START), chat_id=chat_id, limit=limit
+    ).scalar()
+    if not seq or seq < 1:
+        return []
+    with db:
+        dropped = [
+            (row['text'], decode_tokens(row['tokens'])) for row in
+            db.query(SELECT_DROPPED, chat_id=chat_id, seq=seq)
+        ]
+        db.executable.execute(text(DELETE_DROPPED), chat_id=chat_id, seq=seq)
+    return dropped
+
+
+def iter_messages(chat_id):
+    """Stream the text and tokens of a chat's messages, oldest first."""
+    logger.debug(f'streaming messages for chat-id:{chat_id}')
+    for row in db.query(SELECT_MESSAGES, chat_id=chat_id, _step=QUERY_STEP):
+        yield row['text'], decode_tokens(row['tokens'])
+
+
+def delete_messages(chat_id):
+    logger.debug(f'deleting messages for chat-id:{chat_id}')
+    db.executable.execute(text(DELETE_MESSAGES), chat_id=chat_id)
+
+
+def exit_on_sigterm():
+    """Exit on SIGTERM like on ctrl-c, so atexit handlers get to run.
+
+    Only the main thread may set signal handlers, and handlers set before
+    are left alone.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, terminate)
+
+
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+class WriteBuffer(Background):
+    """Accumulate per-chat updates in memory and write them in bulk.
+
+    ``save`` is called as ``save(chat_id, messages, counts)`` for every chat
+    with pending updates, all inside a single transaction. Buffers are
+    flushed every ``interval`` seconds, as soon as ``size`` messages are
+    pending, and when the interpreter exits, SIGTERM included. When a write
+    fails, its updates are kept for the next one and ``evict(chat_id)`` is
+    called for each of its chats, as ``save`` may have changed what is
+    cached about them before the transaction was rolled back.
+    """
+
+    def __init__(self, save, interval, size, evict=None):
+        super().__init__()
+        self.save = save
+        self.evict = evict
+        self.interval = interval
+        self.size = size
+        self.lock = threading.Lock()
+        self.flush_lock = threading.RLock()
+        self.wake = threading.Event()
+        self.chats = {}
+        exit_on_sigterm()
+
+    def add(self, chat_id, message, counts):
+        with self.lock:
+            self.merge(chat_id, [message], counts)
+            full = sum(len(m) for m, _ in self.chats.values()) >= self.size
+        self.start()
+        if full:
+            self.wake.set()
+
+    def merge(self, chat_id, messages, counts):
+        pending_messages, pending_counts = self.chats.setdefault(
+            chat_id, ([], {})
+        )
+        pending_messages.extend(messages)
+        chain.count_transitions(pending_counts, counts)
+
+    def pending(self, chat_id):
+        """Return copies of the messages and counts not yet written."""
+        with self.lock:
+            messages, counts = self.chats.get(chat_id, ([], {}))
+            return list(messages), {s: dict(f) for s, f in counts.items()}
+
+    def discard(self, chat_id):
+        with self.lock:
+            self.chats.pop(chat_id, None)
+
+    def flush(self):
+        with self.flush_lock:
+            self.write()
+
+    def write(self):
+        with self.lock:
+            chats, self.chats = self.chats, {}
+        if not chats:
+            return
+        logger.debug(f'flushing updates for {len(chats)} chats')
+        try:
+            with db:
+                for chat_id, (messages, counts) in chats.items():
+                    self.save(chat_id, messages, counts)
+        except Exception as er:
+            logger.error(f'could not flush updates: {er}')
+            with self.lock:
+                newer, self.chats = self.chats, {}
+                for pending in (chats, newer):
+                    for chat_id, (messages, counts) in pending.items():
+                        self.merge(chat_id, messages, counts)
+            if self.evict:
+                for chat_id in chats:
+                    self.evict(chat_id)
+
+    def start(self):
+        if super().start():
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+
+class ChainFiles(Background):
+    """Mapped chain files of every chat, kept in the directory ``path``.
+
+    ``build(chat_id)`` returns the last message seq of a chat and its chain
+    model as of that seq. Files are rebuilt by a background thread ``delay``
+    seconds after ``schedule`` is called for a chat, so a burst of messages
+    only costs one rebuild. Every mapped chain holds a file descriptor until
+    it is freed, so at most ``limit`` are mapped at a time.
+    """
+
+    def __init__(self, path, build, delay, limit):
+        super().__init__()
+        self.path = path
+        self.build = build
+        self.delay = delay
+        self.limit = limit
+        self.mapped = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.due = {}
+
+    def filename(self, chat_id):
+        return os.path.join(self.path, f'{chat_id}.chain')
+
+    def open(self, chat_id, seq):
+        """Map the chain file of a chat, if it was built at ``seq``.
+
+        Missing or outdated files are scheduled to be rebuilt. None is also
+        returned while ``limit`` chains are mapped already.
+        """
+        if not seq:
+            return None
+        with self.lock:
+            if len(self.mapped) >= self.limit:
+                return None
+        try:
+            mapped = chain.MappedChain(self.filename(chat_id))
+        except FileNotFoundError:
+            mapped = None
+        except (OSError, ValueError) as er:
+            logger.error(f'cannot map chain file of chat-id:{chat_id}: {er}')
+            mapped = None
+        if mapped is None or mapped.seq != seq:
+            self.schedule(chat_id)
+            return None
+        with self.lock:
+            self.mapped.add(mapped)
+        return mapped
+
+    def schedule(self, chat_id):
+        with self.lock:
+            self.due.setdefault(chat_id, time.monotonic() + self.delay)
+        self.start()
+        self.wake.set()
+
+    def remove(self, chat_id):
+        with self.lock:
+            self.due.pop(chat_id, None)
+        # wait for a rebuild of the chat that may be running
+        with self.write_lock:
+            try:
+                os.remove(self.filename(chat_id))
+            except FileNotFoundError:
+                pass
+
+    def write(self, chat_id):
+        seq, model = self.build(chat_id)
+        if not seq or not model:
+            return
+        logger.debug(f'writing chain file of chat-id:{chat_id}')
+        os.makedirs(self.path, exist_ok=True)
+        chain.write_mapped(self.filename(chat_id), model, seq)
+
+    def ready(self):
+        """Pop the chats due for a rebuild, and how long until the next."""
+        with self.lock:
+            now = time.monotonic()
+            ready = [
+                chat_id for chat_id, due in self.due.items() if due <= now
+            ]
+            for chat_id in ready:
+                del self.due[chat_id]
+            timeout = min(self.due.values()) - now if self.due else None
+        return ready, timeout
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            ready, timeout = self.ready()
+            for chat_id in ready:
+                with self.write_lock:
+                    try:
+                        self.write(chat_id)
+                    except Exception as er:
+                        logger.error(
+                            f'could not write chain file of chat-id:{chat_id}:'
+                            f' {er}'
+                        )
+            if not ready:
+                self.wake.wait(timeout)
+
+
+class Deferred(Background):
+    """Run ``func(chat_id)`` in the background for the chats marked.
+
+    ``func`` is called every ``interval`` seconds for each chat marked since
+    the last round, off the path of the messages themselves. ``action`` is
+    what it does, for the logs.
+    """
+
+    def __init__(self, func, interval, action):
+        super().__init__()
+        self.func = func
+        self.interval = interval
+        self.action = action
+        self.lock = threading.Lock()
+        self.chats = set()
+
+    def mark(self, chat_id):
+        with self.lock:
+            self.chats.add(chat_id)
+        self.start()
+
+    def discard(self, chat_id):
+        with self.lock:
+            self.chats.discard(chat_id)
+
+    def run_once(self):
+        with self.lock:
+            chats, self.chats = self.chats, set()
+        for chat_id in chats:
+            try:
+                self.func(chat_id)
+            except Exception as er:
+                logger.error(
+                    f'could not {self.action} chat-id:{chat_id}: {er}'
+                )
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+
+class Compactor(Deferred):
+    """Compact the chains of changed chats in the background."""
+
+    def __init__(self, compact, interval):
+        super().__init__(compact, interval, 'compact')
@@ -0,0 +1,84 @@
+import json
+import asyncio
+import logging
+import telebot
+from concurrent.futures import ThreadPoolExecutor
+from markov.markov import bot, bot_username, members_changed, notify_admin
+from markov.markov import serve_metrics
+from markov.dispatcher import ALLOWED_UPDATES
+from markov.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# largest update body accepted, in bytes
+MAX_BODY = 1 << 20
+
+# updates are handed to the bot on a single thread, in the order received
+executor = ThreadPoolExecutor(max_workers=1)
+
+
+def receive(method, path, body):
+    """Queue the update in a request body, returning the response status."""
+    if path != settings.WEBHOOK_PATH:
+        return '404 Not Found'
+    if method != 'POST':
+        return '405 Method Not Allowed'
+    try:
+        data = json.loads(body)
+        update = telebot.types.Update.de_json(data)
+        members_changed(data)
+    except (ValueError, KeyError, TypeError):
+        logger.error('received an invalid update')
+        return '400 Bad Request'
+    executor.submit(bot.process_new_updates, [update])
+    return '200 OK'
+
+
+async def handle(reader, writer):
+    try:
+        request = await reader.readline()
+        method, path, _ = request.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            status = '413 Payload Too Large'
+        else:
+            status = receive(method, path, await reader.readexactly(length))
+    except (ValueError, asyncio.IncompleteReadError):
+        status = '400 Bad Request'
+    writer.write(
+        f'HTTP/1.1 {status}\r\n'
+        f'Content-Length: 0\r\n'
+        f'Connection: close\r\n\r\n'.encode('latin-1')
+    )
+    await writer.drain()
+    writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f'listening for updates on {host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    notify_admin('starting the bot')
+    bot_username()
+    serve_metrics()
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=settings.WEBHOOK_URL + settings.WEBHOOK_PATH,
+        allowed_updates=ALLOWED_UPDATES
+    )
+    asyncio.run(serve(settings.WEBHOOK_HOST, settings.WEBHOOK_PORT))
+
+
+if __name__ == '__main__':
+    main()
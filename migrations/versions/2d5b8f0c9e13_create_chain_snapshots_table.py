@@ -0,0 +1,36 @@
+"""create chain_snapshots table
+
+Revision ID: 2d5b8f0c9e13
+Revises: 9e4a1c7d3f62
+Create Date: 2026-10-18 14:02:51.660384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d5b8f0c9e13'
+down_revision = '9e4a1c7d3f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # snapshots are written the next time each chain is loaded
+    op.create_table(
+        'chain_snapshots',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('chat_id', sa.String, nullable=False),
+        sa.Column('seq', sa.Integer, nullable=False),
+        sa.Column('data', sa.LargeBinary, nullable=False)
+    )
+    op.create_index(
+        'ix_chain_snapshots_chat_id', 'chain_snapshots', ['chat_id'],
+        unique=True
+    )
+
+
+def downgrade():
+    op.drop_index('ix_chain_snapshots_chat_id', 'chain_snapshots')
+    op.drop_table('chain_snapshots')
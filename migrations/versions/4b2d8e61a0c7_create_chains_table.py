@@ -0,0 +1,94 @@
+"""create chains table
+
+Revision ID: 4b2d8e61a0c7
+Revises: 1f302cefcf31
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b2d8e61a0c7'
+down_revision = '1f302cefcf31'
+branch_labels = None
+depends_on = None
+
+messages = sa.table(
+    'messages',
+    sa.column('chat_id', sa.String),
+    sa.column('chain', sa.String)
+)
+
+chains = sa.table(
+    'chains',
+    sa.column('chat_id', sa.String),
+    sa.column('state', sa.String),
+    sa.column('next_word', sa.String),
+    sa.column('count', sa.Integer)
+)
+
+
+def upgrade():
+    op.create_table(
+        'chains',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('chat_id', sa.String, nullable=False),
+        sa.Column('state', sa.String, nullable=False),
+        sa.Column('next_word', sa.String, nullable=False),
+        sa.Column('count', sa.Integer, nullable=False)
+    )
+    op.create_index(
+        'ix_chains_chat_id_state_next_word', 'chains',
+        ['chat_id', 'state', 'next_word'], unique=True
+    )
+
+    # convert the json chains into transition rows
+    conn = op.get_bind()
+    query = sa.select([messages.c.chat_id, messages.c.chain])
+    for chat_id, chain in conn.execute(query).fetchall():
+        if not chain:
+            continue
+        rows = [
+            {
+                'chat_id': chat_id,
+                'state': json.dumps(state),
+                'next_word': word,
+                'count': count
+            }
+            for state, follows in json.loads(json.loads(chain))
+            for word, count in follows.items()
+        ]
+        op.bulk_insert(chains, rows)
+
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('chain')
+
+
+def downgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('chain', sa.String))
+
+    # convert the transition rows back into json chains
+    conn = op.get_bind()
+    models = {}
+    query = sa.select([
+        chains.c.chat_id, chains.c.state, chains.c.next_word, chains.c.count
+    ])
+    for chat_id, state, word, count in conn.execute(query).fetchall():
+        follows = models.setdefault(chat_id, {}).setdefault(state, {})
+        follows[word] = count
+    for chat_id, model in models.items():
+        chain = json.dumps([
+            [json.loads(state), follows] for state, follows in model.items()
+        ])
+        conn.execute(
+            messages.update().where(messages.c.chat_id == chat_id).values(
+                chain=json.dumps(chain)
+            )
+        )
+
+    op.drop_index('ix_chains_chat_id_state_next_word', 'chains')
+    op.drop_table('chains')
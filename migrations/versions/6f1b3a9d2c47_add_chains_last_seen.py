@@ -0,0 +1,29 @@
+"""add chains last_seen
+
+Revision ID: 6f1b3a9d2c47
+Revises: 2d5b8f0c9e13
+Create Date: 2026-10-18 15:41:22.906514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1b3a9d2c47'
+down_revision = '2d5b8f0c9e13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing transitions count as the least recently seen
+    with op.batch_alter_table('chains') as batch_op:
+        batch_op.add_column(
+            sa.Column('last_seen', sa.Integer, nullable=True)
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('chains') as batch_op:
+        batch_op.drop_column('last_seen')
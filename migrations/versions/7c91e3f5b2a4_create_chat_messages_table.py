@@ -0,0 +1,80 @@
+"""create chat_messages table
+
+Revision ID: 7c91e3f5b2a4
+Revises: 4b2d8e61a0c7
+Create Date: 2026-10-18 10:03:47.218906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c91e3f5b2a4'
+down_revision = '4b2d8e61a0c7'
+branch_labels = None
+depends_on = None
+
+messages = sa.table(
+    'messages',
+    sa.column('chat_id', sa.String),
+    sa.column('text', sa.String)
+)
+
+chat_messages = sa.table(
+    'chat_messages',
+    sa.column('chat_id', sa.String),
+    sa.column('seq', sa.Integer),
+    sa.column('text', sa.String)
+)
+
+
+def upgrade():
+    op.create_table(
+        'chat_messages',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('chat_id', sa.String, nullable=False),
+        sa.Column('seq', sa.Integer, nullable=False),
+        sa.Column('text', sa.String, nullable=False)
+    )
+    op.create_index(
+        'ix_chat_messages_chat_id_seq', 'chat_messages',
+        ['chat_id', 'seq'], unique=True
+    )
+
+    # split the concatenated text into one row per line
+    conn = op.get_bind()
+    query = sa.select([messages.c.chat_id, messages.c.text])
+    for chat_id, text in conn.execute(query).fetchall():
+        lines = filter(None, (text or '').splitlines())
+        rows = [
+            {'chat_id': chat_id, 'seq': seq, 'text': line}
+            for seq, line in enumerate(lines, 1)
+        ]
+        op.bulk_insert(chat_messages, rows)
+
+    op.drop_table('messages')
+
+
+def downgrade():
+    op.create_table(
+        'messages',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('chat_id', sa.String),
+        sa.Column('text', sa.String)
+    )
+
+    # join the message log back into a single text per chat
+    conn = op.get_bind()
+    texts = {}
+    query = sa.select([chat_messages.c.chat_id, chat_messages.c.text])
+    query = query.order_by(chat_messages.c.chat_id, chat_messages.c.seq)
+    for chat_id, text in conn.execute(query).fetchall():
+        texts.setdefault(chat_id, []).append(text)
+    op.bulk_insert(messages, [
+        {'chat_id': chat_id, 'text': '\n'.join(lines)}
+        for chat_id, lines in texts.items()
+    ])
+
+    op.drop_index('ix_chat_messages_chat_id_seq', 'chat_messages')
+    op.drop_table('chat_messages')
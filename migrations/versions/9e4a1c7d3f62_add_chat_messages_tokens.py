@@ -0,0 +1,27 @@
+"""add chat_messages tokens
+
+Revision ID: 9e4a1c7d3f62
+Revises: 7c91e3f5b2a4
+Create Date: 2026-10-18 11:24:09.513740
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a1c7d3f62'
+down_revision = '7c91e3f5b2a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing messages are tagged again the next time they are needed
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.add_column(sa.Column('tokens', sa.String, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.drop_column('tokens')
@@ -1,5 +1,32 @@
+import os
 import pytest
+import dataset
+from unittest import mock
 from attrdict import AttrDict
+from alembic import command
+from alembic.config import Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def migrate(tmp_path, monkeypatch):
+    url = f'sqlite:///{tmp_path / "markov.db"}'
+    monkeypatch.setenv('DATABASE_URL', url)
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'migrations'))
+
+    def upgrade(revision='head'):
+        command.upgrade(config, revision)
+        return dataset.connect(url)
+    return upgrade
+
+
+@pytest.fixture
+def database(migrate):
+    db = migrate()
+    with mock.patch('markov.storage.db', db):
+        yield db
 
 
 @pytest.fixture
@@ -21,12 +48,16 @@ def message():
 def one_found():
     return {
         'chat_id': -1,
-        'text': 'Hello, world!',
-        'chain': (
-            '"[[[\\"___BEGIN__\\", \\"___BEGIN__\\"], {\\"Hello,\\": 1}], '
-            '[[\\"___BEGIN__\\", \\"Hello,\\"], {\\"world!\\": 1}], '
-            '[[\\"Hello,\\", \\"world!\\"], {\\"___END__\\": 1}]]"'
-        )
+        'text': 'Hello, world!'
+    }
+
+
+@pytest.fixture
+def one_chain():
+    return {
+        ('___BEGIN__', '___BEGIN__'): {'Hello,': 1},
+        ('___BEGIN__', 'Hello,'): {'world!': 1},
+        ('Hello,', 'world!'): {'___END__': 1}
     }
 
 
@@ -0,0 +1,29 @@
+import threading
+from markov.background import Background
+
+
+class Counter(Background):
+    def __init__(self, workers):
+        super().__init__()
+        self.args = [(i,) for i in range(workers)]
+        self.ran = []
+        self.done = threading.Event()
+
+    def workers(self):
+        return self.args
+
+    def run(self, i):
+        self.ran.append(i)
+        if len(self.ran) == len(self.args):
+            self.done.set()
+
+
+def test_background_starts_once():
+    counter = Counter(3)
+    assert counter.start()
+    assert not counter.start()
+    assert counter.done.wait(1)
+    for thread in counter.threads:
+        thread.join(1)
+    assert sorted(counter.ran) == [0, 1, 2]
+    assert all(thread.daemon for thread in counter.threads)
@@ -0,0 +1,149 @@
+import json
+import random
+import markovify
+from markov import chain
+from pytest import mark, raises
+
+
+def build(lines):
+    return markovify.NewlineText('\n'.join(lines)).chain
+
+
+def test_count_transitions_removes_empty_entries():
+    model = build(['bla bla bla', 'foo bar']).model
+    chain.count_transitions(model, build(['foo bar']).model, weight=-1)
+    assert model == build(['bla bla bla']).model
+
+
+@mark.parametrize('p_cls', [chain.Chain, chain.CompactChain])
+@mark.parametrize('p_limit', [1, 2, 3])
+def test_update_chain_matches_rebuild(p_cls, p_limit):
+    corpus = [
+        'Hello, world!', 'bla bla bla', 'hello there world',
+        'foo bar baz', 'bla bla foo', 'Hello, world!'
+    ]
+    model = p_cls(None, 2, build(corpus[:p_limit]).model)
+    for i in range(p_limit, len(corpus)):
+        added = build([corpus[i]])
+        removed = build([corpus[i - p_limit]])
+        model = chain.update_chain(model, added=added, removed=removed)
+        expected = build(corpus[i - p_limit + 1:i + 1])
+        assert model.model == expected.model
+        assert len(model) == sum(map(len, expected.model.values()))
+
+
+def test_chain_begin_state():
+    model = chain.Chain(None, 2, build(['bla bla bla']).model)
+    model.update(build(['foo bar']).model)
+    assert sorted(model.begin_choices) == ['bla', 'foo']
+    assert ('foo', 'bar') in model
+    assert ('bar', 'foo') not in model
+
+
+def test_compact_chain_matches_markovify():
+    corpus = ['Hello, world!', 'bla bla bla', 'hello there world', 'bla bla']
+    expected = build(corpus)
+    model = chain.CompactChain(None, 2, expected.model)
+    assert model.model == expected.model
+    assert ('bla', 'bla') in model
+    assert ('bla', 'unknown') not in model
+    random.seed(42)
+    expected_walks = [expected.walk() for _ in range(20)]
+    random.seed(42)
+    assert [model.walk() for _ in range(20)] == expected_walks
+    random.seed(42)
+    expected_moves = [expected.move(('bla', 'bla')) for _ in range(20)]
+    random.seed(42)
+    assert [model.move(('bla', 'bla')) for _ in range(20)] == expected_moves
+
+
+def test_chain_reuses_tables_until_updated():
+    corpus = ['Hello, world!', 'bla bla bla', 'hello there world', 'bla bla']
+    expected = build(corpus)
+    model = chain.Chain(None, 2, build(corpus).model)
+    random.seed(42)
+    expected_walks = [expected.walk() for _ in range(20)]
+    random.seed(42)
+    assert [model.walk() for _ in range(20)] == expected_walks
+    assert ('bla', 'bla') in model.tables
+    model.update(build(['bla bla foo']).model)
+    assert ('bla', 'bla') not in model.tables
+    assert ('Hello,', 'world!') in model.tables
+    model.move(('bla', 'bla'))
+    assert 'foo' in model.tables[('bla', 'bla')][0]
+
+
+def test_serialize_round_trip():
+    model = build(['Hello, world!', 'olá mundo', 'bla bla bla']).model
+    data = chain.serialize(model)
+    assert data.startswith(chain.MAGIC)
+    assert chain.deserialize(data) == model
+    assert chain.deserialize(memoryview(data)) == model
+    assert chain.deserialize(chain.serialize({})) == {}
+
+
+def test_deserialize_json():
+    expected = build(['Hello, world!', 'bla bla bla'])
+    assert chain.deserialize(expected.to_json()) == expected.model
+    stored = json.dumps(expected.to_json()).encode()
+    assert chain.deserialize(stored) == expected.model
+
+
+@mark.parametrize('p_data', [
+    b'MKCH', b'MKCH\x02' + bytes(14), b'not a chain',
+    chain.serialize(build(['bla bla bla']).model)[:-1]
+])
+def test_deserialize_invalid(p_data):
+    with raises(ValueError):
+        chain.deserialize(p_data)
+
+
+def test_mapped_chain_matches_compact(tmp_path):
+    corpus = ['Hello, world!', 'olá mundo', 'bla bla bla', 'bla bla']
+    expected = chain.CompactChain(None, 2, build(corpus).model)
+    chain.write_mapped(tmp_path / 'chain', expected.model, 7)
+    model = chain.MappedChain(tmp_path / 'chain')
+    assert model.seq == 7
+    assert model.model == expected.model
+    assert len(model) == len(expected)
+    assert ('bla', 'bla') in model
+    assert ('bla', 'unknown') not in model
+    random.seed(42)
+    expected_walks = [expected.walk() for _ in range(20)]
+    random.seed(42)
+    assert [model.walk() for _ in range(20)] == expected_walks
+    random.seed(42)
+    expected_moves = [expected.move(('bla', 'bla')) for _ in range(20)]
+    random.seed(42)
+    assert [model.move(('bla', 'bla')) for _ in range(20)] == expected_moves
+
+
+@mark.parametrize('p_data', [
+    b'', b'MKMM', b'not a chain at all, not even close',
+    b'MKMM\x02' + bytes(27)
+])
+def test_mapped_chain_invalid(tmp_path, p_data):
+    (tmp_path / 'chain').write_bytes(p_data)
+    with raises(ValueError):
+        chain.MappedChain(tmp_path / 'chain')
+
+
+def test_mapped_chain_truncated(tmp_path):
+    chain.write_mapped(tmp_path / 'chain', build(['bla bla bla']).model, 1)
+    data = (tmp_path / 'chain').read_bytes()
+    (tmp_path / 'chain').write_bytes(data[:-1])
+    with raises(ValueError):
+        chain.MappedChain(tmp_path / 'chain')
+
+
+@mark.parametrize('p_cls', [chain.Chain, chain.CompactChain, 'mapped'])
+def test_pruned_states_end_sentences(p_cls, tmp_path):
+    model = build(['bla foo bar', 'bla foo bar']).model
+    del model[('bla', 'foo')]
+    if p_cls == 'mapped':
+        chain.write_mapped(tmp_path / 'chain', model, 1)
+        pruned = chain.MappedChain(tmp_path / 'chain')
+    else:
+        pruned = p_cls(None, 2, model)
+    assert pruned.walk() == ['bla', 'foo']
+    assert pruned.move(('bla', 'foo')) == chain.END
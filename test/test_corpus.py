@@ -0,0 +1,50 @@
+from markov import corpus
+from pytest import mark
+from unittest import mock
+
+
+@mark.parametrize('p_words,p_size,p_expected', [
+    ('hello there world', 2, True),
+    ('there world hello', 2, True),
+    ('world hello there', 3, False),
+    ('bla foo bla', 2, False),
+    ('bla', 2, True),
+    ('foo', 2, False),
+    ('world bla', 2, False),
+    ('a c', 2, True),
+    ('b a b', 3, False)
+])
+def test_overlap_index_contains(p_words, p_size, p_expected):
+    index = corpus.OverlapIndex([
+        'hello there world'.split(), 'bla bla bla'.split(),
+        'a b a c'.split()
+    ])
+    assert index.contains(p_words.split(), p_size) == p_expected
+
+
+def test_overlap_index_add_and_remove():
+    index = corpus.OverlapIndex(['bla bla bla'.split()])
+    assert not index.contains('foo bar'.split(), 2)
+    index.add(['foo bar baz'.split()])
+    assert index.contains('foo bar'.split(), 2)
+    index.remove(['foo bar baz'.split(), 'not indexed'.split()])
+    assert not index.contains('foo bar'.split(), 2)
+    assert index.contains('bla bla'.split(), 2)
+    index.remove(['bla bla bla'.split()])
+    assert not index.contains('bla bla'.split(), 2)
+    assert len(index) == 0
+    assert index.words == {}
+
+
+def test_overlap_index_reads_source_lazily():
+    source = mock.Mock(return_value=iter(['bla bla bla'.split()]))
+    index = corpus.OverlapIndex(source=source)
+    index.add(['foo bar'.split()])
+    index.remove(['bla bla bla'.split()])
+    assert not source.called
+    assert index.contains('bla bla'.split(), 2)
+    assert not index.contains('foo bar'.split(), 2)
+    assert len(index) == 1
+    index.add(['foo bar'.split()])
+    assert index.contains('foo bar'.split(), 2)
+    source.assert_called_once_with()
@@ -0,0 +1,97 @@
+import threading
+from markov import dispatcher
+from unittest import mock
+from attrdict import AttrDict
+
+
+def blocked(tasks):
+    """Hold the worker of chat -1 until the returned event is set."""
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    tasks.put(-1, dispatcher.MESSAGE, block)
+    started.wait()
+    return release
+
+
+def test_dispatcher_keeps_chat_order():
+    tasks = dispatcher.Dispatcher(workers=3, size=100)
+    done = {}
+    for chat_id in range(5):
+        for i in range(20):
+            tasks.put(chat_id, dispatcher.MESSAGE,
+                      done.setdefault(chat_id, []).append, i)
+    tasks.join()
+    assert done == {chat_id: list(range(20)) for chat_id in range(5)}
+
+
+def test_dispatcher_runs_commands_first():
+    tasks = dispatcher.Dispatcher(workers=1, size=100)
+    release = blocked(tasks)
+    done = []
+    tasks.put(-1, dispatcher.MESSAGE, done.append, 'message')
+    tasks.put(-1, dispatcher.COMMAND, done.append, 'command')
+    release.set()
+    tasks.join()
+    assert done == ['command', 'message']
+
+
+def test_dispatcher_drops_when_full():
+    tasks = dispatcher.Dispatcher(workers=1, size=1, timeout=0)
+    release = blocked(tasks)
+    done = []
+    assert tasks.put(-1, dispatcher.MESSAGE, done.append, 1)
+    assert not tasks.put(-1, dispatcher.MESSAGE, done.append, 2)
+    release.set()
+    tasks.join()
+    assert done == [1]
+
+
+def test_dispatcher_survives_errors():
+    tasks = dispatcher.Dispatcher(workers=1, size=10)
+    done = []
+    tasks.put(-1, dispatcher.MESSAGE, mock.Mock(side_effect=ValueError))
+    tasks.put(-1, dispatcher.MESSAGE, done.append, 1)
+    tasks.join()
+    assert done == [1]
+
+
+def test_dispatcher_idle():
+    tasks = dispatcher.Dispatcher(workers=2, size=10)
+    assert tasks.idle()
+    release = blocked(tasks)
+    assert not tasks.idle()
+    release.set()
+    tasks.join()
+    assert tasks.idle()
+
+
+def test_dispatching_bot(message):
+    tasks = mock.Mock()
+    bot = dispatcher.DispatchingBot('token', tasks)
+    handler = mock.Mock()
+    bot._exec_task(handler, message)
+    command = AttrDict({'chat': message.chat, 'text': '/sentence'})
+    bot._exec_task(handler, command)
+    assert tasks.put.call_args_list == [
+        mock.call(message.chat.id, dispatcher.MESSAGE, handler, message),
+        mock.call(message.chat.id, dispatcher.COMMAND, handler, command)
+    ]
+    assert not handler.called
+
+
+@mock.patch('markov.dispatcher.telebot.apihelper.get_updates')
+def test_dispatching_bot_get_updates(mock_get_updates):
+    member = {'update_id': 1, 'my_chat_member': {'chat': {'id': -1}}}
+    mock_get_updates.return_value = [member]
+    bot = dispatcher.DispatchingBot('token', mock.Mock())
+    bot.received = mock.Mock()
+    updates = bot.get_updates(offset=1, timeout=5)
+    mock_get_updates.assert_called_once_with(
+        'token', 1, None, 5, dispatcher.ALLOWED_UPDATES
+    )
+    bot.received.assert_called_once_with(member)
+    assert updates[0].update_id == 1
@@ -1,8 +1,10 @@
 from markov import filters
+from markov.settings import patterns
+from pytest import mark
 from unittest import mock
 
 
-@mock.patch('markov.filters.filters', [r'^hello'])
+@mock.patch('markov.filters.engine', filters.FilterEngine({'h': r'^hello'}))
 def test_message_filter(message):
     assert filters.message_filter(message)
     message.text = 'Hello, World'
@@ -12,3 +14,32 @@ def test_message_filter(message):
 def test_empty_message(message):
     message.text = None
     assert not filters.message_filter(message)
+
+
+@mark.parametrize('p_text,p_expected', [
+    ('bla bla bla', None),
+    ('write to joao@example.com', 'email'),
+    ('see https://example.com/a?b=c', 'url'),
+    ('call 555-1234 now', 'phone'),
+    ('Buy Now, cheap', 'keywords'),
+    ('buy nowhere', None)
+])
+@mock.patch('markov.filters.settings')
+def test_filter_engine(mock_settings, p_text, p_expected):
+    mock_settings.FILTERS = ['email', 'url', 'unknown']
+    mock_settings.FILTER_PATTERNS = {'phone': r'\d{3}-\d{4}'}
+    mock_settings.FILTER_KEYWORDS = ['buy now', 'cheap pills']
+    engine = filters.FilterEngine(filters.enabled_patterns())
+    assert engine.names == ['email', 'url', 'phone', 'keywords']
+    assert engine.match(p_text) == p_expected
+
+
+def test_filter_engine_without_filters():
+    assert filters.FilterEngine({}).match('bla bla bla') is None
+
+
+def test_filter_patterns_setting():
+    assert patterns('') == {}
+    assert patterns(r'phone=\d{3}-\d{4}; a=b=c;') == {
+        'phone': r'\d{3}-\d{4}', 'a': 'b=c'
+    }
@@ -0,0 +1,124 @@
+import io
+import json
+import importlib
+from markov import filters, storage
+from pytest import fixture, mark, raises
+from unittest import mock
+
+importer = importlib.import_module('markov.import')
+
+
+@fixture
+def export():
+    return {
+        'name': 'test chat',
+        'type': 'private_supergroup',
+        'id': 42,
+        'messages': [
+            {'id': 1, 'type': 'service', 'action': 'create_group'},
+            {'id': 2, 'type': 'message', 'text': 'Hello, world!'},
+            {'id': 3, 'type': 'message', 'text': [
+                'see ', {'type': 'bold', 'text': 'this'}, ' thing'
+            ]},
+            {'id': 4, 'type': 'message', 'text': ''},
+            {'id': 5, 'type': 'message', 'text': '/sentence'},
+            {'id': 6, 'type': 'message', 'text': 'mail me at a@b.com'}
+        ]
+    }
+
+
+@mark.parametrize('p_data,p_expected', [
+    (
+        {'type': 'private_group', 'id': 7, 'messages': []},
+        [('-7', [])]
+    ),
+    (
+        {'chats': {'list': [
+            {'type': 'personal_chat', 'id': 8, 'messages': [{'text': 'a'}]},
+            {'type': 'public_channel', 'id': 9}
+        ]}},
+        [('8', ['a']), ('-1009', [])]
+    )
+])
+def test_read_export(p_data, p_expected):
+    f = io.StringIO(json.dumps(p_data))
+    assert list(importer.read_export(f)) == p_expected
+
+
+@mark.parametrize('p_read_size', [1, 3, 4096])
+def test_read_export_in_chunks(export, p_read_size):
+    data = {'about': {'nested': [1, 2.5, None, 'x']}, 'chats': {
+        'about': 'skipped', 'list': [export, {'id': 12345, 'messages': [
+            {'text': 'número 10'}, {'text': ['a', {'text': '"b"'}]}
+        ]}]
+    }}
+    f = io.StringIO(json.dumps(data, indent=1))
+    with mock.patch.object(importer, 'READ_SIZE', p_read_size):
+        chats = importer.read_export(f)
+        chat_id, texts = next(chats)
+        assert chat_id == '-10042'
+        assert len(texts) == 4
+        if p_read_size < 10:
+            # the rest of the export is not read before it is needed
+            assert f.tell() < len(f.getvalue())
+        assert list(chats) == [('12345', ['número 10', 'a"b"'])]
+
+
+def test_read_export_truncated(export):
+    f = io.StringIO(json.dumps(export)[:-20])
+    with raises(ValueError):
+        list(importer.read_export(f))
+
+
+def test_read_file(tmp_path, export):
+    path = tmp_path / 'result.json'
+    path.write_text(json.dumps(export))
+    (chat_id, texts), = importer.read_file(str(path))
+    assert chat_id == '-10042'
+    assert texts == [
+        'Hello, world!', 'see this thing', '/sentence', 'mail me at a@b.com'
+    ]
+    path = tmp_path / 'lines.txt'
+    path.write_text('foo bar\n\nbla bla bla\n')
+    assert list(importer.read_file(str(path), '-1')) == [
+        ('-1', ['foo bar', 'bla bla bla'])
+    ]
+    with raises(ValueError):
+        list(importer.read_file(str(path)))
+
+
+@mock.patch('markov.speech.process_texts')
+def test_build_chat_tags_in_a_batch(
+    mock_process_texts, nlp_output, parsed_sentences
+):
+    mock_process_texts.side_effect = lambda texts, language: [
+        nlp_output for _ in texts
+    ]
+    with mock.patch.multiple(importer.settings, MODEL_LANG=['en']):
+        chat_id, messages, counts = importer.build_chat(
+            '-1', ['bla bla bla', 'bla "bla"\nbla', '(bla']
+        )
+    assert mock_process_texts.call_count == 1
+    assert chat_id == '-1'
+    assert messages == [
+        ('bla bla bla', parsed_sentences),
+        ('bla "bla"\nbla', parsed_sentences * 2)
+    ]
+    assert counts[('___BEGIN__', '___BEGIN__')] == {'bla::X::compound': 3}
+
+
+@mark.parametrize('p_jobs', [1, 2])
+def test_main(database, tmp_path, export, p_jobs):
+    path = tmp_path / 'result.json'
+    path.write_text(json.dumps(export))
+    engine = filters.FilterEngine({'email': filters.PATTERNS['email']})
+    with mock.patch('markov.filters.engine', engine), mock.patch.multiple(
+        importer.settings, MODEL_LANG='', GROW_CHAIN=False, MESSAGE_LIMIT=2
+    ):
+        importer.main([str(path), '--chat', '-1', '-j', str(p_jobs)])
+    assert list(storage.iter_messages('-1')) == [
+        ('Hello, world!', None), ('see this thing', None)
+    ]
+    expected = importer.speech.new_model(
+        'Hello, world!\nsee this thing').chain.model
+    assert storage.load_chain('-1') == expected
@@ -1,7 +1,17 @@
-from markov import markov
+from markov import markov, speech
+from pytest import fixture
 from unittest import mock
 
 
+@fixture(autouse=True)
+def caches():
+    markov.bot_username.cache_clear()
+    markov.admins.clear()
+    yield
+    markov.bot_username.cache_clear()
+    markov.admins.clear()
+
+
 @mock.patch('markov.markov.generate_sentence')
 @mock.patch('markov.speech.update_model')
 @mock.patch('markov.markov.bot')
@@ -194,3 +204,53 @@ def test_help(mock_bot, message):
 def test_start(mock_bot, message):
     markov.start(message)
     assert mock_bot.reply_to.called
+
+
+@mock.patch('markov.markov.bot')
+def test_bot_username_is_fetched_once(mock_bot):
+    mock_bot.get_me.return_value.username = 'markov_bot'
+    assert markov.bot_username() == markov.bot_username() == 'markov_bot'
+    assert mock_bot.get_me.call_count == 1
+
+
+@mock.patch('markov.markov.bot')
+def test_chat_admins_are_cached(mock_bot, message):
+    mock_bot.get_chat_administrators.return_value = [message]
+    assert markov.chat_admins('-1') == ['joao']
+    assert markov.chat_admins('-1') == ['joao']
+    assert mock_bot.get_chat_administrators.call_count == 1
+    markov.forget_admins(-1)
+    mock_bot.get_chat_administrators.return_value = []
+    assert markov.chat_admins('-1') == []
+
+
+@mock.patch('markov.markov.forget_admins')
+def test_members_changed(mock_forget_admins):
+    assert markov.bot.received == markov.members_changed
+    markov.members_changed({'update_id': 1, 'message': {}})
+    assert not mock_forget_admins.called
+    markov.members_changed({'chat_member': {'chat': {'id': -1}}})
+    mock_forget_admins.assert_called_once_with(-1)
+
+
+@mock.patch('markov.speech.load_model')
+@mock.patch('markov.speech.models', {})
+@mock.patch('markov.markov.bot')
+def test_get_metrics(mock_bot, mock_load_model, message):
+    mock_bot.get_chat_administrators.return_value = [message]
+    markov.get_metrics(message)
+    report = mock_bot.reply_to.call_args[0][1]
+    assert 'markov_model_size 0' in report
+    assert not mock_load_model.called
+    speech.models['-1'] = mock.Mock(chain={'a': 1, 'b': 2})
+    markov.get_metrics(message)
+    report = mock_bot.reply_to.call_args[0][1]
+    assert 'markov_model_size 2' in report
+    assert '_bucket' not in report
+
+
+@mock.patch('markov.markov.bot')
+def test_get_metrics_no_permission(mock_bot, message):
+    mock_bot.get_chat_administrators.return_value = []
+    markov.get_metrics(message)
+    mock_bot.reply_to.assert_called_once_with(message, 'u r not an admin 🤔')
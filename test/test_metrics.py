@@ -0,0 +1,71 @@
+import urllib.request
+from markov import metrics
+from pytest import fixture
+from unittest import mock
+
+
+@fixture
+def registry():
+    with mock.patch('markov.metrics.registry', []) as registry:
+        yield registry
+
+
+def test_counter(registry):
+    counter = metrics.Counter('hits_total', 'Hits')
+    counter.inc(result='hit')
+    counter.inc(2, result='hit')
+    counter.inc(result='miss')
+    assert metrics.render() == (
+        '# HELP hits_total Hits\n'
+        '# TYPE hits_total counter\n'
+        'hits_total{result="hit"} 3\n'
+        'hits_total{result="miss"} 1\n'
+    )
+
+
+def test_gauge(registry):
+    gauge = metrics.Gauge('size', 'Size')
+    gauge.set(3, chat_id='-1')
+    gauge.set(5, chat_id='-2')
+    gauge.remove(chat_id='-1')
+    assert list(gauge.samples()) == [('size', (('chat_id', '-2'),), 5)]
+    gauge.collect = lambda: {(('chat_id', '-3'),): 7}
+    assert list(gauge.samples()) == [('size', (('chat_id', '-3'),), 7)]
+
+
+def test_histogram(registry):
+    histogram = metrics.Histogram('seconds', 'Seconds', buckets=(0.1, 1))
+    histogram.observe(0.5, stage='nlp')
+    histogram.observe(2, stage='nlp')
+    assert list(histogram.samples()) == [
+        ('seconds_bucket', (('stage', 'nlp'), ('le', '0.1')), 0),
+        ('seconds_bucket', (('stage', 'nlp'), ('le', '1')), 1),
+        ('seconds_bucket', (('stage', 'nlp'), ('le', '+Inf')), 2),
+        ('seconds_count', (('stage', 'nlp'),), 2),
+        ('seconds_sum', (('stage', 'nlp'),), 2.5)
+    ]
+
+
+@mock.patch('markov.metrics.time.perf_counter')
+def test_histogram_time(mock_perf_counter, registry):
+    histogram = metrics.Histogram('seconds', 'Seconds', buckets=(1,))
+    mock_perf_counter.side_effect = [1, 1.5, 2, 4]
+
+    @histogram.time(stage='nlp')
+    def parse():
+        pass
+
+    parse()
+    parse()
+    assert histogram.values == {(('stage', 'nlp'),): [1, 2, 2.5]}
+
+
+def test_serve(registry):
+    metrics.Counter('hits_total', 'Hits').inc()
+    server = metrics.serve('127.0.0.1', 0)
+    url = f'http://127.0.0.1:{server.server_port}/metrics'
+    try:
+        with urllib.request.urlopen(url) as response:
+            assert 'hits_total 1' in response.read().decode()
+    finally:
+        server.shutdown()
@@ -0,0 +1,79 @@
+import time
+from markov import pool
+from pytest import fixture
+from unittest import mock
+
+
+@fixture
+def sentences():
+    generate = mock.Mock(side_effect=lambda chat_id: f'hi {chat_id}')
+    with mock.patch.object(pool.SentencePool, 'start'):
+        yield pool.SentencePool(generate, size=2, ttl=60, changes=1, chats=10)
+
+
+def test_take_and_refill(sentences):
+    assert sentences.take('-1') is None
+    assert sentences.wake.is_set()
+    assert sentences.wanting() == ['-1']
+    assert sentences.refill('-1')
+    assert sentences.refill('-1')
+    assert not sentences.refill('-1')
+    assert not sentences.refill('-2')
+    assert sentences.wanting() == []
+    assert sentences.take('-1') == 'hi -1'
+    assert sentences.wanting() == ['-1']
+
+
+def test_changes_age_sentences_out(sentences):
+    sentences.take('-1')
+    sentences.refill('-1')
+    sentences.changed('-1')
+    sentences.refill('-1')
+    sentences.changed('-1')
+    assert sentences.take('-1') == 'hi -1'
+    assert sentences.take('-1') is None
+
+
+@mock.patch('markov.pool.time')
+def test_ttl_ages_sentences_out(mock_time, sentences):
+    mock_time.monotonic.return_value = 0
+    sentences.take('-1')
+    sentences.refill('-1')
+    mock_time.monotonic.return_value = 61
+    assert sentences.take('-1') is None
+
+
+def test_exhausted_until_changed(sentences):
+    sentences.generate.side_effect = None
+    sentences.generate.return_value = None
+    sentences.take('-1')
+    assert not sentences.refill('-1')
+    assert sentences.wanting() == []
+    sentences.changed('-1')
+    assert sentences.wanting() == ['-1']
+
+
+def test_retried_when_nothing_to_generate_from(sentences):
+    sentences.generate.side_effect = KeyError('-1')
+    sentences.take('-1')
+    assert not sentences.refill('-1')
+    assert sentences.wanting() == ['-1']
+
+
+def test_discarded_while_generating(sentences):
+    sentences.take('-1')
+    sentences.generate.side_effect = lambda chat_id: sentences.discard(
+        chat_id) or 'hi'
+    assert not sentences.refill('-1')
+    assert sentences.take('-1') is None
+
+
+def test_refill_in_background():
+    generate = mock.Mock(return_value='hi')
+    sentences = pool.SentencePool(generate, size=3, ttl=60, changes=1,
+                                  chats=10)
+    sentences.take('-1')
+    deadline = time.monotonic() + 5
+    while sentences.wanting() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [sentences.take('-1') for _ in range(3)] == ['hi'] * 3
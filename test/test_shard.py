@@ -0,0 +1,189 @@
+import os
+import signal
+import collections
+from markov import shard, speech
+from markov.dispatcher import ALLOWED_UPDATES
+from pytest import fixture, mark, raises
+from unittest import mock
+
+
+class RecordingWorker:
+    """A worker that writes what it was asked to do to a file per shard."""
+
+    def __init__(self, index, shards, path):
+        self.index = index
+        self.log = open(f'{path}/{index}.log', 'a', buffering=1)
+        self.log.write(f'start {shards}\n')
+
+    def handle(self, update):
+        self.log.write(f'handle {shard.update_chat(update)}\n')
+
+    def rebalance(self, shards):
+        self.log.write(f'rebalance {shards}\n')
+
+    def stop(self):
+        self.log.write('stop\n')
+        self.log.close()
+
+
+class DyingWorker(RecordingWorker):
+    """A recording worker whose first shard dies instead of rebalancing."""
+
+    def rebalance(self, shards):
+        if self.index == 0 and shards == 3:
+            os._exit(1)
+        super().rebalance(shards)
+
+
+@fixture
+def bot():
+    with mock.patch('markov.markov.bot') as bot:
+        bot.dispatcher.join.return_value = None
+        yield bot
+
+
+@fixture
+def models():
+    speech.models.clear()
+    yield speech.models
+    speech.models.clear()
+
+
+def update(chat_id, kind='message'):
+    return {'update_id': 1, kind: {'chat': {'id': chat_id}}}
+
+
+def test_hash_ring_is_balanced():
+    ring = shard.HashRing(4)
+    counts = collections.Counter(ring.shard(-i) for i in range(10000))
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert min(counts.values()) > 1500
+
+
+@mark.parametrize('p_before,p_after', [(3, 4), (4, 3), (1, 2)])
+def test_hash_ring_moves_few_chats(p_before, p_after):
+    before, after = shard.HashRing(p_before), shard.HashRing(p_after)
+    moved = [
+        i for i in range(10000) if before.shard(i) != after.shard(i)
+    ]
+    changed = max(p_before, p_after) - 1
+    assert all(changed in (before.shard(i), after.shard(i)) for i in moved)
+    assert len(moved) < 10000 * 1.5 / max(p_before, p_after)
+
+
+def test_hash_ring_invalid():
+    with raises(ValueError):
+        shard.HashRing(0)
+
+
+@mark.parametrize('p_update,p_expected', [
+    (update(-1), -1),
+    (update(-2, 'edited_message'), -2),
+    (update(-3, 'my_chat_member'), -3),
+    ({'callback_query': {'message': {'chat': {'id': -4}}}}, -4),
+    ({'update_id': 1, 'poll': {'id': '5'}}, None)
+])
+def test_update_chat(p_update, p_expected):
+    assert shard.update_chat(p_update) == p_expected
+
+
+def test_worker_rebalance(bot, models):
+    worker = shard.Worker(0, 2)
+    ring = shard.HashRing(3)
+    chat_ids = [str(-i) for i in range(20)]
+    for chat_id in chat_ids:
+        models[chat_id] = mock.MagicMock()
+    with mock.patch.dict(speech.chat_languages, {'-30': {'en': 1}}):
+        worker.rebalance(3)
+        assert ('-30' in speech.chat_languages) == (ring.shard('-30') == 0)
+    assert bot.dispatcher.join.called
+    assert sorted(models) == sorted(
+        chat_id for chat_id in chat_ids if ring.shard(chat_id) == 0
+    )
+
+
+@mock.patch('markov.speech.sentences')
+def test_worker_rebalance_drops_pools(mock_sentences, bot, models):
+    mock_sentences.lock = mock.MagicMock()
+    mock_sentences.pools = {str(-i): None for i in range(20)}
+    shard.Worker(0, 2).rebalance(3)
+    ring = shard.HashRing(3)
+    assert sorted(
+        call[0][0] for call in mock_sentences.discard.call_args_list
+    ) == sorted(
+        str(-i) for i in range(20) if ring.shard(str(-i)) != 0
+    )
+
+
+@mock.patch('markov.markov.forget_admins')
+def test_worker_handle(mock_forget_admins, bot):
+    worker = shard.Worker(0, 1)
+    worker.handle(update(-1, 'my_chat_member'))
+    mock_forget_admins.assert_called_once_with(-1)
+    worker.handle({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': 'bla',
+        'chat': {'id': -1, 'type': 'group'}
+    }})
+    (updates,), _ = bot.process_new_updates.call_args
+    assert updates[0].message.chat.id == -1
+
+
+def test_router(tmp_path):
+    chats = range(-1, -31, -1)
+    router = shard.Router(2, worker=RecordingWorker, args=(str(tmp_path),))
+    router.start()
+    for chat_id in chats:
+        router.route(update(chat_id))
+    router.resize(3)
+    for chat_id in chats:
+        router.route(update(chat_id))
+    router.resize(2)
+    router.stop()
+    logs = {
+        index: (tmp_path / f'{index}.log').read_text().splitlines()
+        for index in range(3)
+    }
+    two, three = shard.HashRing(2), shard.HashRing(3)
+    assert logs[0] == ['start 2'] + [
+        f'handle {c}' for c in chats if two.shard(c) == 0
+    ] + ['rebalance 3'] + [
+        f'handle {c}' for c in chats if three.shard(c) == 0
+    ] + ['rebalance 2', 'stop']
+    assert logs[2] == ['start 3'] + [
+        f'handle {c}' for c in chats if three.shard(c) == 2
+    ] + ['rebalance 2', 'stop']
+
+
+@mock.patch('markov.shard.telebot.apihelper.get_updates')
+def test_poll(mock_get_updates):
+    router = mock.Mock()
+    router.check.side_effect = [None, SystemExit]
+    mock_get_updates.return_value = [update(-1)]
+    with raises(SystemExit):
+        shard.poll(router)
+    router.route.assert_called_once_with(update(-1))
+    (*_, allowed_updates), _ = mock_get_updates.call_args
+    assert allowed_updates == ALLOWED_UPDATES
+
+
+@mock.patch('markov.shard.poll')
+@mock.patch('markov.shard.Router')
+@mock.patch('markov.shard.signal.signal')
+def test_main_stops_on_sigterm(mock_signal, mock_router, mock_poll):
+    def poll(router):
+        handlers = dict(call[0] for call in mock_signal.call_args_list)
+        handlers[signal.SIGTERM](signal.SIGTERM, None)
+    mock_poll.side_effect = poll
+    with raises(SystemExit):
+        shard.main()
+    assert mock_router.return_value.stop.called
+
+
+def test_router_survives_dying_worker(tmp_path):
+    router = shard.Router(2, worker=DyingWorker, args=(str(tmp_path),))
+    router.start()
+    router.resize(3)
+    router.stop()
+    assert (tmp_path / '0.log').read_text().splitlines() == [
+        'start 2', 'start 3', 'stop'
+    ]
@@ -1,83 +1,192 @@
+import os
+import sys
+import subprocess
 from markov import speech
-from pytest import mark, raises
+from pytest import fixture, mark, raises
 from unittest import mock
 from attrdict import AttrDict
+from test.conftest import ROOT
 
+# seconds importing the bot may take, spaCy models and all
+IMPORT_BUDGET = 1.5
 
-@mock.patch('markov.speech.LanguageDetector')
-@mock.patch('markov.speech.spacy')
-def test_load_nlp_models(mock_spacy, mock_language_detector):
+
+@fixture(autouse=True)
+def models():
+    speech.models.clear()
+    speech.chat_languages.clear()
+    yield speech.models
+    speech.models.clear()
+    speech.chat_languages.clear()
+
+
+@mock.patch('spacy.load')
+@mock.patch('markov.speech.settings')
+def test_load_nlp_models(mock_settings, mock_load):
     lang = 'en'
     proc = mock.Mock()
-    mock_spacy.load.return_value = proc
+    mock_settings.NLP_DISABLE = ['ner']
+    mock_load.return_value = proc
     nlp = speech.load_nlp_models([lang])
-    assert isinstance(nlp, AttrDict)
-    assert 'languages' in nlp
-    assert 'processors' in nlp
-    assert nlp.languages == (lang,)
-    assert nlp.processors == ((lang, proc),)
+    assert nlp.languages == [lang]
+    assert not mock_load.called
+    assert nlp[lang] is nlp[lang] is proc
+    mock_load.assert_called_once_with(lang, disable=['ner'])
 
 
-@mock.patch('markov.speech.LanguageDetector')
-def test_load_nlp_models_invalid_lang(mock_language_detector):
+def test_load_nlp_models_invalid_lang():
     nlp = speech.load_nlp_models(['zz'])
-    assert nlp is None
+    with raises(KeyError):
+        nlp['zz']
+    assert nlp.languages == []
+
+
+@mock.patch('spacy.load')
+def test_load_nlp_models_falls_back(mock_load):
+    proc = mock.Mock()
+    mock_load.side_effect = [OSError, proc]
+    nlp = speech.load_nlp_models(['zz', 'en'])
+    assert nlp['zz'] is proc
+    assert nlp.languages == ['en']
+
+
+def test_import_time():
+    code = (
+        'import sys, time; start = time.perf_counter(); '
+        'import markov.speech; '
+        'print(time.perf_counter() - start, "spacy" in sys.modules)'
+    )
+    env = dict(os.environ, MODEL_LANG='en')
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, check=True, universal_newlines=True
+    )
+    elapsed, spacy_loaded = result.stdout.split()
+    assert float(elapsed) < IMPORT_BUDGET
+    assert spacy_loaded == 'False'
 
 
 def test_load_nlp_models_no_lang():
     assert speech.load_nlp_models('') is None
 
 
-@mock.patch('markov.speech.nlp')
-def test_process_text(mock_nlp, nlp_output, message):
-    doc = mock.Mock()
-    doc.return_value = nlp_output
-    doc._.language_scores = {'en': 0.87}
-    mock_nlp.languages = ['en']
-    mock_nlp.processors = [('en', lambda t: doc)]
-    assert speech.process_text(message.text) == doc
+def pipelines(**loaded):
+    nlp = speech.Pipelines(loaded)
+    nlp.loaded.update(loaded)
+    return nlp
 
 
-@mock.patch('markov.speech.nlp')
-def test_process_text_guessed_lang(mock_nlp, nlp_output, message):
-    doc1 = mock.Mock()
-    doc1.return_value = nlp_output
-    doc1._.language_scores = {'en': 0.11, 'pt': 0.89}
+@mark.parametrize('p_text,p_language,p_expected', [
+    ('hello, how are you doing today my friend?', None, 'en'),
+    ('olá, como você está hoje meu amigo?', None, 'pt'),
+    ('olá, como você está hoje meu amigo?', 'en', 'en')
+])
+def test_process_text(p_text, p_language, p_expected):
+    en, pt = mock.Mock(), mock.Mock()
+    nlp = pipelines(en=en, pt=pt)
+    with mock.patch('markov.speech.nlp', nlp):
+        doc = speech.process_text(p_text, p_language)
+    assert doc == nlp[p_expected].return_value
+    nlp[p_expected].assert_called_once_with(p_text)
+    assert en.call_count + pt.call_count == 1
 
-    doc2 = mock.Mock()
-    doc2.return_value = reversed(nlp_output)
-    doc2._.language_scores = {'en': 0.11, 'pt': 0.89}
 
+@mock.patch('markov.speech.nlp', None)
+def test_process_text_without_nlp(message):
+    assert speech.process_text(message.text) == message.text
+
+
+@mark.parametrize('p_text,p_expected', [
+    ('hello, how are you doing today my friend?', 'en'),
+    ('olá, como você está hoje meu amigo?', 'pt'),
+    ('bonjour, comment allez-vous aujourd hui mon ami?', 'en'),
+    ('', 'en')
+])
+@mock.patch('markov.speech.nlp')
+def test_detect_language(mock_nlp, p_text, p_expected):
     mock_nlp.languages = ['en', 'pt']
-    mock_nlp.processors = [('en', lambda t: doc1), ('pt', lambda t: doc2)]
-    assert speech.process_text(message.text) == doc2
+    assert speech.detect_language(p_text) == p_expected
+
+
+@mock.patch('markov.speech.settings')
+def test_process_texts(mock_settings):
+    en, pt = mock.Mock(), mock.Mock()
+    en.pipe.side_effect = lambda texts, **kwargs: [t.upper() for t in texts]
+    pt.pipe.side_effect = lambda texts, **kwargs: [t.title() for t in texts]
+    mock_settings.NLP_BATCH_SIZE = 64
+    mock_settings.NLP_PROCESSES = 2
+    with mock.patch('markov.speech.nlp', pipelines(en=en, pt=pt)):
+        docs = speech.process_texts([
+            'hello, how are you doing today my friend?',
+            'olá, como você está hoje meu amigo?',
+            'i am fine, thank you very much for asking'
+        ])
+    assert docs == [
+        'HELLO, HOW ARE YOU DOING TODAY MY FRIEND?',
+        'Olá, Como Você Está Hoje Meu Amigo?',
+        'I AM FINE, THANK YOU VERY MUCH FOR ASKING'
+    ]
+    assert en.pipe.call_count == pt.pipe.call_count == 1
+    assert en.pipe.call_args[1] == {'batch_size': 64, 'n_process': 2}
+
+
+@mock.patch('markov.speech.settings')
+def test_process_texts_known_language(mock_settings):
+    en, pt = mock.Mock(), mock.Mock()
+    en.pipe.return_value = []
+    with mock.patch('markov.speech.nlp', pipelines(en=en, pt=pt)):
+        speech.process_texts(['olá, como você está hoje meu amigo?'], 'en')
+    assert en.pipe.called
+    assert not pt.pipe.called
+
+
+@mock.patch('markov.speech.detect_language')
+@mock.patch('markov.speech.settings')
+def test_message_language(mock_settings, mock_detect_language):
+    mock_settings.LANGUAGE_SAMPLE = 2
+    mock_detect_language.side_effect = ['en', 'pt', 'pt', 'pt']
+    with mock.patch('markov.speech.nlp', pipelines(en=None, pt=None)):
+        languages = [speech.message_language('-1', 'bla') for _ in range(3)]
+        assert languages == ['en', 'pt', 'pt']
+        assert speech.chat_language('-1') is None
+        speech.chat_languages['-2'] = speech.collections.Counter(pt=2)
+        assert speech.message_language('-2', 'bla') == 'pt'
+    assert mock_detect_language.call_count == 3
+    speech.flush(AttrDict({'id': -2}))
+    assert speech.chat_language('-2') is None
 
 
 @mock.patch('markov.speech.nlp', None)
-def test_process_text_without_nlp(message):
-    assert speech.process_text(message.text) == message.text
+def test_process_texts_without_nlp(message):
+    assert speech.process_texts(iter([message.text])) == [message.text]
 
 
+@mock.patch('markov.speech.process_texts')
 @mock.patch.object(speech.PosifiedText, 'word_join')
-@mock.patch.object(speech.PosifiedText, 'word_split')
+@mock.patch.object(speech.PosifiedText, 'tag_words')
 def test_PosifiedText_sequence(
-    mock_word_split, mock_word_join, parsed_sentences, message
+    mock_tag_words, mock_word_join, mock_process_texts,
+    parsed_sentences, message
 ):
     mock_word_join.return_value = message.text
-    mock_word_split.return_value = parsed_sentences[0]
+    mock_tag_words.return_value = parsed_sentences[0]
+    mock_process_texts.side_effect = lambda texts, language: list(texts)
     speech.PosifiedText(message.text)
-    assert mock_word_split.called
+    mock_tag_words.assert_called_once_with(message.text)
     assert mock_word_join.called
 
 
-@mock.patch('markov.speech.process_text')
+@mock.patch('markov.speech.process_texts')
 def test_PosifiedText_values(
-    mock_process_text, nlp_output, parsed_sentences, message
+    mock_process_texts, nlp_output, parsed_sentences, message
 ):
-    mock_process_text.return_value = nlp_output
+    mock_process_texts.return_value = [nlp_output]
     model = speech.PosifiedText(message.text)
-    assert model.parsed_sentences == parsed_sentences
-    assert model.rejoined_text == message.text
+    assert list(model.overlap.sentences) == [('bla', 'bla', 'bla')]
+    assert model.word_join(parsed_sentences[0]) == message.text
+    assert model.chain.model[('bla::X::compound', 'bla::NOUN::ROOT')] == {
+        '___END__': 1
+    }
 
 
 @mock.patch('markov.speech.settings')
@@ -95,77 +204,183 @@ def test_new_model_with_invalid_msg(mock_settings, message):
     assert not model
 
 
-@mock.patch('markov.speech.process_text')
+@mock.patch('markov.speech.process_texts')
 @mock.patch('markov.speech.settings')
 def test_new_model_with_nlp(
-    mock_settings, mock_process_text, nlp_output, message
+    mock_settings, mock_process_texts, nlp_output, message
 ):
     mock_settings.MODEL_LANG = ['en']
-    mock_process_text.return_value = nlp_output
+    mock_process_texts.return_value = [nlp_output]
     model = speech.new_model(message.text)
     assert isinstance(model, speech.PosifiedText)
 
 
-@mock.patch('markov.speech.db')
-def test_get_model(mock_db, one_found, message):
-    mock_db.find_one.return_value = one_found
+@mock.patch('markov.speech.storage')
+def test_get_model(mock_storage, one_found, one_chain, message):
+    mock_storage.load_chain.return_value = one_chain
+    mock_storage.iter_messages.return_value = iter([
+        (one_found['text'], None)
+    ])
     model = speech.get_model(message.chat)
-    assert mock_db.find_one.called
+    assert mock_storage.load_chain.called
     assert isinstance(model, speech.markovify.NewlineText)
+    assert model.chain.model == one_chain
+    assert list(model.overlap.sentences) == [('Hello,', 'world!')]
 
 
-@mark.parametrize('p_grow,p_limit,expected_text,expected_chain', [
-    (
-        True,
-        None,
-        'Hello, world!\nbla bla bla',
-        (
-            '"[[[\\"___BEGIN__\\", \\"___BEGIN__\\"], {\\"Hello,\\": 1, '
-            '\\"bla\\": 1}], [[\\"___BEGIN__\\", \\"Hello,\\"], '
-            '{\\"world!\\": 1}], [[\\"Hello,\\", \\"world!\\"], '
-            '{\\"___END__\\": 1}], [[\\"___BEGIN__\\", \\"bla\\"], '
-            '{\\"bla\\": 1}], [[\\"bla\\", \\"bla\\"], {\\"bla\\": 1, '
-            '\\"___END__\\": 1}]]"'
-        )
-    ),
-    (
-        False,
-        1,
-        'bla bla bla',
-        (
-            '"[[[\\"___BEGIN__\\", \\"___BEGIN__\\"], {\\"bla\\": 1}], '
-            '[[\\"___BEGIN__\\", \\"bla\\"], {\\"bla\\": 1}], [[\\"bla\\", '
-            '\\"bla\\"], {\\"bla\\": 1, \\"___END__\\": 1}]]"'
-        )
-    )
+@mock.patch('markov.speech.CORPUS_CHUNK', 1)
+@mock.patch('markov.speech.message_tokens')
+@mock.patch('markov.speech.storage')
+def test_get_model_reads_corpus_lazily(
+    mock_storage, mock_message_tokens, one_chain, message
+):
+    mock_storage.load_chain.return_value = one_chain
+    mock_storage.iter_messages.return_value = iter([
+        ('Hello, world!', None), ('bla bla bla', None)
+    ])
+    mock_message_tokens.side_effect = lambda messages, language: [
+        text.split() for text, _ in messages
+    ]
+    model = speech.get_model(message.chat)
+    assert not mock_storage.iter_messages.called
+    assert model.make_sentence() is None
+    assert mock_message_tokens.call_count == 2
+    assert list(model.overlap.sentences) == [
+        ('Hello,', 'world!'), ('bla', 'bla', 'bla')
+    ]
+
+
+@mark.parametrize('p_grow,p_dropped', [
+    (True, []),
+    (False, []),
+    (False, [('Hello, world!', None)]),
+    (False, [('Hello, world!', [['Hello,', 'world!']])])
 ])
-@mock.patch('markov.speech.db')
+@mock.patch('markov.speech.storage')
 @mock.patch('markov.speech.settings')
 def test_update_model(
-    mock_settings, mock_db, p_grow, p_limit,
-    expected_text, expected_chain, one_found, message
+    mock_settings, mock_storage, p_grow, p_dropped, message
 ):
+    chat_id = str(message.chat.id)
     mock_settings.MODEL_LANG = ''
     mock_settings.GROW_CHAIN = p_grow
-    mock_settings.MESSAGE_LIMIT = p_limit
-    mock_db.find_one.return_value = one_found
+    mock_settings.MESSAGE_LIMIT = 1
+    mock_storage.trim_messages.return_value = p_dropped
+    speech.update_model(message.chat, message.text)
+    mock_storage.append_messages.assert_called_once_with(
+        chat_id, [(message.text, None)])
+    assert mock_storage.trim_messages.called != p_grow
+    calls = mock_storage.count_transitions.call_args_list
+    added = speech.new_model(message.text).chain.model
+    seq = mock_storage.append_messages.return_value
+    assert calls[0] == mock.call(chat_id, added, seen=seq)
+    if p_dropped:
+        removed = speech.new_model(p_dropped[0][0]).chain.model
+        assert calls[1] == mock.call(chat_id, removed, -1)
+    else:
+        assert len(calls) == 1
+
+
+@mock.patch('markov.speech.process_texts')
+@mock.patch('markov.speech.storage')
+@mock.patch('markov.speech.settings')
+def test_update_model_stores_tags(
+    mock_settings, mock_storage, mock_process_texts, nlp_output, message
+):
+    mock_settings.MODEL_LANG = ['en']
+    mock_settings.GROW_CHAIN = True
+    mock_process_texts.return_value = [nlp_output]
+    speech.update_model(message.chat, message.text)
+    tokens = speech.new_model(message.text).parsed_sentences
+    mock_storage.append_messages.assert_called_once_with(
+        str(message.chat.id), [(message.text, tokens)])
+
+
+@mock.patch('markov.speech.process_texts')
+@mock.patch('markov.speech.storage')
+@mock.patch('markov.speech.settings')
+def test_get_model_reuses_tags(
+    mock_settings, mock_storage, mock_process_texts, message
+):
+    tokens = [['Hello::INTJ::ROOT', 'world::NOUN::npadvmod']]
+    mock_settings.MODEL_LANG = ['en']
+    mock_storage.load_chain.return_value = speech.new_model(
+        None, tokens).chain.model
+    mock_storage.iter_messages.return_value = iter([('Hello world', tokens)])
+    model = speech.get_model(message.chat)
+    assert not mock_process_texts.called
+    assert list(model.overlap.sentences) == [('Hello', 'world')]
+
+
+@mock.patch('markov.speech.buffer')
+@mock.patch('markov.speech.storage')
+@mock.patch('markov.speech.settings')
+def test_update_model_write_behind(
+    mock_settings, mock_storage, mock_buffer, message
+):
+    mock_settings.MODEL_LANG = ''
     speech.update_model(message.chat, message.text)
-    assert mock_db.find_one.called
-    assert mock_db.upsert.called_once_with({
-        'chat_id': message.chat.id,
-        'text': expected_text,
-        'chain': expected_chain
-    }, ['chat_id'])
+    added = speech.new_model(message.text).chain.model
+    mock_buffer.add.assert_called_once_with(
+        str(message.chat.id), (message.text, None), added)
+    assert not mock_storage.append_messages.called
 
 
-@mock.patch('markov.speech.db')
 @mock.patch('markov.speech.settings')
-def test_update_model_with_invalid_msg(mock_settings, mock_db, message):
+def test_failed_flush_evicts_models(mock_settings, database, message):
+    mock_settings.MODEL_LANG = ''
+    mock_settings.COMPACT_CHAIN = False
+    mock_settings.CHAIN_SNAPSHOTS = False
+    mock_settings.RETAIN_ORIG = False
+    mock_settings.GROW_CHAIN = False
+    mock_settings.MESSAGE_LIMIT = 2
+
+    def save(chat_id, messages, counts):
+        speech.save_model(chat_id, messages, counts)
+        if chat_id == '-2':
+            raise ValueError('db is down')
+
+    buffer = speech.storage.WriteBuffer(save, 60, 100, speech.evict_model)
+    speech.models.clear()
+    with mock.patch('markov.speech.buffer', buffer), \
+            mock.patch.object(buffer, 'start'):
+        speech.update_model(message.chat, 'one two')
+        buffer.flush()
+        assert speech.get_model(message.chat)
+        speech.update_model(message.chat, 'three four')
+        speech.update_model(message.chat, 'three four')
+        speech.update_model(mock.Mock(id=-2), 'five six')
+        buffer.flush()
+        assert '-1' not in speech.models
+        model = speech.get_model(message.chat)
+    # the database and the pending updates, trimmed on the next flush
+    assert model.chain.model == speech.new_model(
+        'one two\nthree four\nthree four').chain.model
+
+
+@mock.patch('markov.speech.buffer')
+@mock.patch('markov.speech.storage')
+def test_get_model_with_pending_updates(
+    mock_storage, mock_buffer, one_chain, message
+):
+    mock_storage.load_chain.return_value = {}
+    mock_storage.iter_messages.return_value = iter([])
+    mock_buffer.pending.return_value = (
+        [('Hello, world!', None)], one_chain
+    )
+    model = speech.get_model(message.chat)
+    assert model.chain.model == one_chain
+    assert list(model.overlap.sentences) == [('Hello,', 'world!')]
+
+
+@mock.patch('markov.speech.storage')
+@mock.patch('markov.speech.settings')
+def test_update_model_with_invalid_msg(mock_settings, mock_storage, message):
     mock_settings.MODEL_LANG = ''
     message.text = '\n'
     speech.update_model(message.chat, message.text)
-    assert not mock_db.find_one.called
-    assert not mock_db.upsert.called
+    assert not mock_storage.append_messages.called
+    assert not mock_storage.count_transitions.called
 
 
 @mark.parametrize('p_chat,p_message,p_expected', [
@@ -178,18 +393,138 @@ def test_update_model_raises_exception(p_chat, p_message, p_expected):
     assert str(er.value) == p_expected
 
 
-@mock.patch('markov.speech.get_model')
-@mock.patch('markov.speech.db')
-def test_delete_model(mock_db, mock_get_model, message):
+@mock.patch('markov.speech.storage')
+def test_delete_model(mock_storage, models, message):
+    models['-1'] = models['-2'] = mock.MagicMock()
     speech.delete_model(message.chat)
-    assert mock_db.delete.called_once_with(chat_id=message.chat.id)
-    assert mock_get_model.cache_clear.called
+    mock_storage.delete_messages.assert_called_once_with(
+        str(message.chat.id))
+    mock_storage.delete_chain.assert_called_once_with(str(message.chat.id))
+    assert list(models) == ['-2']
 
 
-@mock.patch('markov.speech.get_model')
-def test_flush(mock_get_model):
-    speech.flush()
-    assert mock_get_model.cache_clear.called
+def test_flush(models, message):
+    models['-1'] = models['-2'] = mock.MagicMock()
+    speech.flush(message.chat)
+    assert list(models) == ['-2']
+
+
+@mock.patch('markov.speech.storage')
+def test_get_model_cached(mock_storage, one_chain, message):
+    mock_storage.load_chain.return_value = one_chain
+    model = speech.get_model(message.chat)
+    assert speech.get_model(message.chat) is model
+    assert mock_storage.load_chain.call_count == 1
+
+
+@mock.patch('markov.speech.storage')
+def test_get_model_too_large(mock_storage, models, one_chain, message):
+    mock_storage.load_chain.return_value = one_chain
+    with mock.patch.object(models, 'getsizeof', lambda m: models.maxsize + 1):
+        assert speech.get_model(message.chat)
+    assert '-1' not in models
+
+
+@mark.parametrize('p_compact', [False, True])
+@mark.parametrize('p_limit', [1, 2])
+@mock.patch('markov.speech.settings')
+def test_update_cached_model(
+    mock_settings, database, p_limit, p_compact, message
+):
+    mock_settings.MODEL_LANG = ''
+    mock_settings.COMPACT_CHAIN = p_compact
+    mock_settings.GROW_CHAIN = False
+    mock_settings.RETAIN_ORIG = True
+    mock_settings.MESSAGE_LIMIT = p_limit
+    speech.update_model(message.chat, 'Hello, world!')
+    cached = speech.get_model(message.chat)
+    speech.update_model(message.chat, message.text)
+    speech.update_model(message.chat, 'foo bar baz')
+    assert speech.get_model(message.chat) is cached
+    speech.flush(message.chat)
+    loaded = speech.get_model(message.chat)
+    assert isinstance(cached.chain, speech.chain_class())
+    assert cached.chain.model == loaded.chain.model
+    assert cached.overlap.sentences == loaded.overlap.sentences
+    assert len(loaded.overlap) == p_limit
+
+
+@mock.patch.object(speech.storage.ChainFiles, 'start')
+@mock.patch('markov.speech.settings')
+def test_get_model_from_chain_file(
+    mock_settings, mock_start, database, tmp_path, message
+):
+    mock_settings.MODEL_LANG = ''
+    mock_settings.COMPACT_CHAIN = False
+    mock_settings.GROW_CHAIN = True
+    mock_settings.RETAIN_ORIG = True
+    path = tmp_path / 'chains'
+    files = speech.storage.ChainFiles(
+        str(path), speech.chain_version, delay=60, limit=10)
+    with mock.patch('markov.speech.chain_files', files):
+        speech.update_model(message.chat, 'Hello, world!')
+        assert list(files.due) == ['-1']
+        files.write('-1')
+        model = speech.get_model(message.chat)
+        assert isinstance(model.chain, speech.MappedChain)
+        assert model.make_sentence(test_output=False) == 'Hello, world!'
+        overlap = model.overlap
+        speech.update_model(message.chat, message.text)
+        assert speech.get_model(message.chat) is model
+        assert isinstance(model.chain, speech.Chain)
+        assert model.chain.model == speech.new_model(
+            'Hello, world!\nbla bla bla').chain.model
+        assert model.overlap is overlap
+        assert len(overlap) == 2
+        files.write('-1')
+        speech.delete_model(message.chat)
+        assert not os.listdir(path)
+
+
+@mock.patch.object(speech.storage.Compactor, 'start')
+@mock.patch('markov.speech.settings')
+def test_compact_model(mock_settings, mock_start, database, message):
+    mock_settings.MODEL_LANG = ''
+    mock_settings.COMPACT_CHAIN = False
+    mock_settings.GROW_CHAIN = True
+    mock_settings.RETAIN_ORIG = True
+    mock_settings.MAX_CHAIN_STATES = 4
+    mock_settings.PRUNE_MIN_COUNT = 2
+    mock_settings.PRUNE_AGE = 1
+    compactor = speech.storage.Compactor(speech.compact_model, interval=60)
+    with mock.patch('markov.speech.compactor', compactor):
+        for text in ['foo bar baz', 'bla bla bla', 'bla bla bla']:
+            speech.update_model(message.chat, text)
+        assert compactor.chats == {'-1'}
+        assert speech.get_model(message.chat)
+        compactor.run_once()
+    assert '-1' not in speech.models
+    assert speech.storage.count_states('-1') == 3
+    model = speech.get_model(message.chat)
+    expected = speech.new_model('bla bla bla\nbla bla bla').chain.model
+    # the begin state is never pruned
+    expected[('___BEGIN__', '___BEGIN__')]['foo'] = 1
+    assert model.chain.model == expected
+
+
+@mock.patch('markov.speech.storage')
+def test_compact_model_blocks_snapshots(mock_storage):
+    locked = []
+    mock_storage.compact_chain.side_effect = lambda *args: locked.append(
+        speech.snapshot_lock.locked())
+    speech.compact_model('-1')
+    assert locked == [True]
+
+
+@mock.patch('markov.speech.settings')
+def test_load_model_without_begin_state(mock_settings, database, message):
+    mock_settings.MODEL_LANG = ''
+    mock_settings.COMPACT_CHAIN = False
+    mock_settings.CHAIN_SNAPSHOTS = False
+    model = speech.new_model('bla bla bla').chain.model
+    del model[('___BEGIN__', '___BEGIN__')]
+    speech.storage.count_transitions('-1', model)
+    assert speech.load_model('-1') is None
 
 
 @mock.patch('markov.speech.get_model')
@@ -208,3 +543,79 @@ def test_new_message_empty_model(mock_get_model, message):
     msg = speech.new_message(message.chat)
     assert mock_get_model.called
     assert msg == 'i need more data'
+
+
+@mock.patch('markov.speech.get_model')
+def test_new_message_rejects_overlap(mock_get_model, message):
+    mock_get_model.return_value = speech.Text('Hello, world!')
+    assert speech.new_message(message.chat) == 'i need more data'
+
+
+@mock.patch('markov.speech.metrics')
+@mock.patch('markov.speech.get_model')
+def test_new_message_counts_failures(mock_get_model, mock_metrics, message):
+    mock_get_model.return_value.make_sentence.return_value = None
+    assert speech.new_message(message.chat) == 'i need more data'
+    assert mock_metrics.generation_failures.inc.called
+
+
+@mock.patch('markov.speech.get_model')
+def test_new_message_from_pool(mock_get_model, database, message):
+    generate = mock.Mock(return_value='Live long and prosper.')
+    sentences = speech.SentencePool(generate, 1, 60, 1, 10)
+    with mock.patch('markov.speech.sentences', sentences), \
+            mock.patch.object(sentences, 'start'):
+        mock_get_model.return_value = None
+        assert speech.new_message(message.chat) == 'i need more data'
+        assert sentences.refill('-1')
+        assert speech.new_message(message.chat) == 'Live long and prosper.'
+        assert mock_get_model.call_count == 1
+        speech.update_model(message.chat, message.text)
+        assert sentences.pools['-1'].version == 1
+        speech.flush(message.chat)
+        assert '-1' not in sentences.pools
+
+
+@mock.patch('markov.speech.load_model')
+@mock.patch('markov.speech.models', {})
+def test_cached_sentence(mock_load_model):
+    with raises(KeyError):
+        speech.cached_sentence('-1')
+    model = speech.models['-1'] = mock.Mock()
+    model.make_sentence.return_value = 'Live long and prosper.'
+    assert speech.cached_sentence('-1') == 'Live long and prosper.'
+    assert not mock_load_model.called
+
+
+@mark.parametrize('p_seq,p_snapshot,p_rebuilt', [
+    (2, None, True),
+    (2, 1, True),
+    (2, 2, False)
+])
+@mock.patch('markov.speech.snapshots')
+@mock.patch('markov.speech.storage')
+def test_read_chain(
+    mock_storage, mock_snapshots, p_seq, p_snapshot, p_rebuilt, one_chain
+):
+    data = speech.serialize(one_chain)
+    mock_storage.last_seq.return_value = p_seq
+    mock_storage.load_snapshot.return_value = p_snapshot and (
+        p_snapshot, data)
+    mock_storage.load_chain.return_value = one_chain
+    assert speech.read_chain('-1') == one_chain
+    assert mock_storage.load_chain.called == p_rebuilt
+    assert not mock_storage.save_snapshot.called
+    if p_rebuilt:
+        mock_snapshots.mark.assert_called_once_with('-1')
+    else:
+        assert not mock_snapshots.mark.called
+
+
+@mock.patch('markov.speech.storage')
+def test_write_snapshot(mock_storage, one_chain):
+    mock_storage.last_seq.return_value = 2
+    mock_storage.load_chain.return_value = one_chain
+    speech.write_snapshot('-1')
+    mock_storage.save_snapshot.assert_called_once_with(
+        '-1', 2, speech.serialize(one_chain)
+    )
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import signal
+import markovify
+import subprocess
+from unittest import mock
+from markov import storage
+
+
+def test_count_transitions(database, one_chain):
+    storage.count_transitions('-1', one_chain)
+    storage.count_transitions('-1', one_chain)
+    assert storage.load_chain('-1') == {
+        state: {word: 2 for word in follows}
+        for state, follows in one_chain.items()
+    }
+    assert storage.load_chain('-2') == {}
+
+
+def test_count_transitions_removes_exhausted(database, one_chain):
+    bla = markovify.NewlineText('bla bla bla').chain.model
+    storage.count_transitions('-1', one_chain)
+    storage.count_transitions('-1', bla)
+    storage.count_transitions('-1', bla, -1)
+    assert storage.load_chain('-1') == one_chain
+    assert database['chains'].count(chat_id='-1') == len(one_chain)
+
+
+def test_delete_chain(database, one_chain):
+    storage.count_transitions('-1', one_chain)
+    storage.count_transitions('-2', one_chain)
+    storage.delete_chain('-1')
+    assert storage.load_chain('-1') == {}
+    assert storage.load_chain('-2') == one_chain
+
+
+def test_convert_json_chains(migrate, one_chain):
+    db = migrate('1f302cefcf31')
+    chain = markovify.Chain(None, 2, one_chain)
+    db['messages'].insert({
+        'chat_id': '-1',
+        'text': 'Hello, world!',
+        'chain': json.dumps(chain.to_json())
+    })
+    db = migrate('4b2d8e61a0c7')
+    assert 'chain' not in db['messages'].columns
+    rows = db['chains'].find(chat_id='-1')
+    assert {
+        (storage.decode_state(r['state']), r['next_word']): r['count']
+        for r in rows
+    } == {
+        (state, word): count
+        for state, follows in one_chain.items()
+        for word, count in follows.items()
+    }
+
+
+def test_append_and_trim_messages(database):
+    storage.append_messages('-1', [(message, None) for message in 'abcd'])
+    storage.append_messages('-2', [('e', None)])
+    assert storage.trim_messages('-1', 5) == []
+    assert storage.trim_messages('-1', 2) == [('a', None), ('b', None)]
+    assert list(storage.iter_messages('-1')) == [('c', None), ('d', None)]
+    storage.append_messages('-1', [('f', [['f::X::ROOT']])])
+    assert storage.trim_messages('-1', 2) == [('c', None)]
+    assert list(storage.iter_messages('-1')) == [
+        ('d', None), ('f', [['f::X::ROOT']])
+    ]
+    assert list(storage.iter_messages('-2')) == [('e', None)]
+
+
+def test_append_messages(database):
+    assert storage.append_messages('-1', [('a', None)]) == 1
+    assert storage.append_messages(
+        '-1', [('b', None), ('c', [['c::X::ROOT']])]) == 3
+    assert storage.append_messages('-1', []) == 3
+    assert storage.last_seq('-1') == 3
+    assert list(storage.iter_messages('-1')) == [
+        ('a', None), ('b', None), ('c', [['c::X::ROOT']])
+    ]
+
+
+def test_delete_messages(database):
+    storage.append_messages('-1', [('a', None)])
+    storage.append_messages('-2', [('b', None)])
+    storage.delete_messages('-1')
+    assert list(storage.iter_messages('-1')) == []
+    assert list(storage.iter_messages('-2')) == [('b', None)]
+
+
+def test_convert_messages_text(migrate):
+    db = migrate('4b2d8e61a0c7')
+    db['messages'].insert({'chat_id': '-1', 'text': '\nbla bla\nfoo bar'})
+    db = migrate()
+    assert 'messages' not in db.tables
+    rows = db['chat_messages'].find(chat_id='-1', order_by='seq')
+    assert [(r['seq'], r['text']) for r in rows] == [
+        (1, 'bla bla'), (2, 'foo bar')
+    ]
+
+
+def test_write_buffer_flush(database, one_chain):
+    save = mock.Mock()
+    buffer = storage.WriteBuffer(save, interval=60, size=10)
+    buffer.merge('-1', ['Hello, world!'], one_chain)
+    buffer.merge('-1', ['Hello, world!'], one_chain)
+    messages, counts = buffer.pending('-1')
+    assert messages == ['Hello, world!', 'Hello, world!']
+    assert counts[('Hello,', 'world!')] == {'___END__': 2}
+    buffer.flush()
+    save.assert_called_once_with('-1', messages, counts)
+    assert buffer.pending('-1') == ([], {})
+
+
+def test_write_buffer_keeps_updates_on_error(database, one_chain):
+    save = mock.Mock(side_effect=ValueError('db is down'))
+    evict = mock.Mock()
+    buffer = storage.WriteBuffer(save, interval=60, size=10, evict=evict)
+    buffer.merge('-1', ['Hello, world!'], one_chain)
+    buffer.flush()
+    assert buffer.pending('-1') == (['Hello, world!'], one_chain)
+    evict.assert_called_once_with('-1')
+
+
+def test_write_buffer_flushes_on_sigterm(migrate):
+    db = migrate()
+    script = (
+        'import os, signal, time\n'
+        'from types import SimpleNamespace\n'
+        'from markov import speech\n'
+        'speech.update_model(SimpleNamespace(id=-1), "Hello, world!")\n'
+        'os.kill(os.getpid(), signal.SIGTERM)\n'
+        'time.sleep(10)\n'
+    )
+    env = dict(os.environ, WRITE_BEHIND='True', FLUSH_INTERVAL='3600')
+    result = subprocess.run([sys.executable, '-c', script], env=env,
+                            timeout=60)
+    assert result.returncode == 128 + signal.SIGTERM
+    assert [row['text'] for row in db['chat_messages'].all()] == [
+        'Hello, world!'
+    ]
+
+
+@mock.patch.object(storage.WriteBuffer, 'start')
+def test_write_buffer_size_threshold(mock_start, one_chain):
+    buffer = storage.WriteBuffer(mock.Mock(), interval=60, size=2)
+    buffer.add('-1', 'Hello, world!', one_chain)
+    assert mock_start.called
+    assert not buffer.wake.is_set()
+    buffer.add('-2', 'Hello, world!', one_chain)
+    assert buffer.wake.is_set()
+
+
+def test_chain_snapshots(database):
+    assert storage.load_snapshot('-1') is None
+    assert storage.last_seq('-1') is None
+    storage.append_messages('-1', [('a', None), ('b', None)])
+    assert storage.last_seq('-1') == 2
+    storage.save_snapshot('-1', 1, b'old')
+    storage.save_snapshot('-1', 2, b'new')
+    storage.save_snapshot('-2', 1, b'other')
+    assert storage.load_snapshot('-1') == (2, b'new')
+    storage.delete_chain('-1')
+    assert storage.load_snapshot('-1') is None
+    assert storage.load_snapshot('-2') == (1, b'other')
+
+
+@mock.patch.object(storage.ChainFiles, 'start')
+def test_chain_files(mock_start, tmp_path, one_chain):
+    build = mock.Mock(return_value=(2, one_chain))
+    files = storage.ChainFiles(
+        str(tmp_path / 'chains'), build, delay=60, limit=1
+    )
+    assert files.open('-1', None) is None
+    assert files.open('-1', 2) is None
+    assert list(files.due) == ['-1']
+    assert files.ready() == ([], mock.ANY)
+    files.write('-1')
+    assert files.open('-1', 3) is None
+    mapped = files.open('-1', 2)
+    assert mapped.model == one_chain
+    # as many chains as allowed are mapped already
+    assert files.open('-1', 2) is None
+    del mapped
+    assert files.open('-1', 2).model == one_chain
+    files.remove('-1')
+    assert not files.due
+    assert not (tmp_path / 'chains' / '-1.chain').exists()
+
+
+def test_chain_files_rebuild_in_background(tmp_path, one_chain):
+    build = mock.Mock(return_value=(2, one_chain))
+    files = storage.ChainFiles(str(tmp_path), build, delay=0, limit=1)
+    files.schedule('-1')
+    deadline = time.monotonic() + 5
+    while not files.open('-1', 2) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert files.open('-1', 2).model == one_chain
+    build.assert_called_with('-1')
+
+
+def test_compact_chain(database):
+    def chain(*lines):
+        return markovify.NewlineText('\n'.join(lines)).chain.model
+
+    storage.append_messages('-1', [('a', None)] * 10)
+    storage.count_transitions('-1', chain('a rare'), seen=1)
+    storage.count_transitions('-1', chain('b common', 'b common'), seen=2)
+    storage.count_transitions('-1', chain('c fresh'), seen=9)
+    storage.save_snapshot('-1', 10, b'snapshot')
+    assert storage.count_states('-1') == 7
+    assert not storage.compact_chain('-1', 7, min_count=2, age=5)
+    assert storage.compact_chain('-1', 6, min_count=2, age=5)
+    expected = chain('b common', 'b common', 'c fresh')
+    # the begin state is left whole
+    expected[('___BEGIN__', '___BEGIN__')]['a'] = 1
+    assert storage.load_chain('-1') == expected
+    assert storage.load_snapshot('-1') is None
+    assert storage.compact_chain('-1', 3, min_count=2, age=5)
+    assert storage.load_chain('-1') == {
+        state: follows for state, follows in expected.items()
+        if 'b' not in state
+    }
+    assert storage.compact_chain('-1', 1, min_count=2, age=5)
+    assert list(storage.load_chain('-1')) == [('___BEGIN__', '___BEGIN__')]
+
+
+def test_compactor():
+    compact = mock.Mock(side_effect=[ValueError('db is down'), None])
+    compactor = storage.Compactor(compact, interval=60)
+    with mock.patch.object(compactor, 'start'):
+        compactor.mark('-1')
+        compactor.mark('-1')
+        compactor.mark('-2')
+        compactor.discard('-2')
+    compactor.run_once()
+    compactor.run_once()
+    compact.assert_called_once_with('-1')
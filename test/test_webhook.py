@@ -0,0 +1,76 @@
+import json
+import asyncio
+from markov import webhook
+from pytest import fixture, mark
+from unittest import mock
+
+
+@fixture
+def update():
+    return {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 1600000000,
+            'chat': {'id': -1, 'type': 'group'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'joao'},
+            'text': 'bla bla bla'
+        }
+    }
+
+
+def post(path, body):
+    async def request():
+        server = await asyncio.start_server(webhook.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(
+            f'POST {path} HTTP/1.1\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        response = await reader.read()
+        writer.close()
+        server.close()
+        return response.decode().split('\r\n')[0]
+    return asyncio.run(request())
+
+
+@mock.patch('markov.webhook.executor')
+@mock.patch('markov.webhook.settings')
+def test_webhook_queues_update(mock_settings, mock_executor, update):
+    mock_settings.WEBHOOK_PATH = '/token'
+    status = post('/token', json.dumps(update).encode())
+    assert status == 'HTTP/1.1 200 OK'
+    func, updates = mock_executor.submit.call_args[0]
+    assert func == webhook.bot.process_new_updates
+    assert updates[0].message.text == 'bla bla bla'
+    assert updates[0].message.chat.id == -1
+
+
+@mark.parametrize('p_path,p_body,p_expected', [
+    ('/other', b'{}', 'HTTP/1.1 404 Not Found'),
+    ('/token', b'not json', 'HTTP/1.1 400 Bad Request'),
+    ('/token', b'{"message": {}}', 'HTTP/1.1 400 Bad Request')
+])
+@mock.patch('markov.webhook.executor')
+@mock.patch('markov.webhook.settings')
+def test_webhook_rejects_request(
+    mock_settings, mock_executor, p_path, p_body, p_expected
+):
+    mock_settings.WEBHOOK_PATH = '/token'
+    assert post(p_path, p_body) == p_expected
+    assert not mock_executor.submit.called
+
+
+@mock.patch('markov.markov.forget_admins')
+@mock.patch('markov.webhook.executor')
+@mock.patch('markov.webhook.settings')
+def test_webhook_forgets_admins(mock_settings, mock_executor, mock_forget):
+    mock_settings.WEBHOOK_PATH = '/token'
+    update = {
+        'update_id': 2,
+        'chat_member': {'chat': {'id': -1, 'type': 'group'}}
+    }
+    assert post('/token', json.dumps(update).encode()) == 'HTTP/1.1 200 OK'
+    mock_forget.assert_called_once_with(-1)
+    assert mock_executor.submit.called